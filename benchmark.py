@@ -0,0 +1,305 @@
+'''
+Benchmarks of the hot paths of the pipeline on a synthetic CORD-19 corpus.
+
+A corpus of pdf_json documents with the matching .sent and .oie files is generated from the words
+of the templates (so template matching finds realistic numbers of candidates and matches), with the
+triples made by a canned stand-in for CoreNLP. Each benchmark runs in a forked process and reports
+its throughput and peak memory, and the results are written as JSON to compare them across commits:
+
+  python benchmark.py --work_dir /tmp/bench --docs 500 --out bench-$(git rev-parse --short HEAD).json
+
+Benchmarks whose dependencies (e.g. spaCy or elasticsearch) are not installed are reported as skipped.
+'''
+from typing import Dict, Iterable, Iterator, List, Tuple
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.abspath(__file__))
+for d in ('oie', 'extraction', 'retrieval'):
+  sys.path.insert(0, os.path.join(root, d))
+from oie_format import Span, Triple, str_to_triples, triples_to_str
+import extract_from_templates
+
+template_file = os.path.join(root, 'extraction', 'cord19-templates.csv')
+filler = ['the', 'of', 'and', 'in', 'patients', 'with', 'was', 'were', 'to', 'a', 'cases', 'is', 'for', 'study',
+          'infection', 'respiratory', 'we', 'clinical', 'data', 'severe', 'as', 'by', 'cells', 'days', '14', '5.2']
+
+
+def canned_triples(text: str) -> List[Triple]:
+  """A deterministic stand-in for the triples CoreNLP extracts from a sentence, with valid character offsets."""
+  toks = [(m.group(), m.start(), m.end()) for m in re.finditer(r'\S+', text)]
+  triples = []
+  for i in range(0, len(toks) - 4, 5):
+    s, r, o = toks[i:i + 2], toks[i + 2:i + 3], toks[i + 3:i + 5]
+    triples.append(Triple(*[Span(' '.join(t for t, _, _ in span), span[0][1], span[-1][2]) for span in (s, r, o)]))
+  return triples
+
+
+class CannedOpenIE:
+  """Answers like `StanfordOpenIE.annotate_batch` without a server, with an optional latency per request."""
+
+  def __init__(self, latency: float = 0.0):
+    self.latency = latency
+
+  def open_session(self, pool_size: int):
+    pass
+
+  def annotate_batch(self, items: Iterable[Tuple[str, str]], batch_size: int = 32, concurrency: int = 4,
+                     max_len: int = 15000, on_skip=None, **kwargs) -> Iterator[Tuple[str, List[Triple]]]:
+    for i, (id, text) in enumerate(items):
+      if self.latency and i % batch_size == 0:
+        time.sleep(self.latency)
+      if len(text) >= max_len:
+        if on_skip is not None:
+          on_skip(i, id, 'max_len')
+        yield id, []
+      else:
+        yield id, canned_triples(text)
+
+
+def template_phrases() -> Tuple[List[str], List[str]]:
+  """The words of the templates, and their text regexes turned into plain phrases with [X] and [Y] left in."""
+  words, phrases = set(), []
+  with open(template_file, 'r') as f:
+    csvf = csv.reader(f)
+    next(csvf)
+    for row in csvf:
+      for regex in extract_from_templates.get_regexes(row[4]) + extract_from_templates.get_regexes(row[3]):
+        phrase = re.sub(r'\.\*|\\\|\\\|\\\||\[B\]', ' ', regex)
+        phrase = re.sub(r'[\\^$.*+?(){}|]', '', phrase)
+        phrases.append(' '.join(phrase.split()))
+        words.update(w for w in re.split(r'[^A-Za-z0-9-]+', phrase) if w and w not in {'X', 'Y'})
+  return sorted(words), phrases
+
+
+def generate_corpus(work_dir: str, n_docs: int, n_paras: int, n_sents: int, seed: int) -> Dict:
+  """Write <work_dir>/pdf_json/*.json, corpus.sent and corpus.oie, and return their sizes."""
+  gen = random.Random(seed)
+  words, phrases = template_phrases()
+  vocab = words + filler * 4
+  virus_names = extract_from_templates.virus_names
+
+  def sentence():
+    toks = [gen.choice(vocab) for _ in range(gen.randint(6, 30))]
+    r = gen.random()
+    if r < 0.15:
+      phrase = gen.choice(phrases).replace('[X]', gen.choice(virus_names))
+      phrase = phrase.replace('[Y]', ' '.join(gen.choice(vocab) for _ in range(gen.randint(1, 3))))
+      toks.insert(gen.randint(0, len(toks)), phrase)
+    elif r < 0.4:
+      toks.insert(gen.randint(0, len(toks)), gen.choice(virus_names))
+    s = ' '.join(toks)
+    return s[0].upper() + s[1:] + '.'
+
+  json_dir = os.path.join(work_dir, 'pdf_json')
+  # Files of an earlier, larger corpus would still be read by the steps that list the directory
+  shutil.rmtree(json_dir, ignore_errors=True)
+  os.makedirs(json_dir)
+  n_lines = 0
+  with open(os.path.join(work_dir, 'corpus.sent'), 'w') as sent_fout, open(os.path.join(work_dir, 'corpus.oie'), 'w') as oie_fout:
+    for d in range(n_docs):
+      sha = '{:040x}'.format(gen.getrandbits(160))
+      fname = os.path.join(json_dir, sha + '.json')
+      paras = [[sentence() for _ in range(gen.randint(1, 2 * n_sents - 1))] for _ in range(n_paras)]
+      doc = {'paper_id': sha,
+             'metadata': {'title': sentence(), 'authors': [{'first': 'A', 'last': 'B', 'affiliation': {}}]},
+             'abstract': [{'text': ' '.join(paras[0]), 'cite_spans': [], 'section': 'Abstract'}],
+             'body_text': [{'text': ' '.join(p), 'cite_spans': [], 'ref_spans': [], 'section': 'Results'} for p in paras[1:]],
+             'bib_entries': {'BIBREF0': {'title': sentence(), 'year': 2019}}}
+      with open(fname, 'w') as f:
+        json.dump(doc, f)
+      for p in paras:
+        for s in p:
+          sent_fout.write('{}\t{}\n'.format(fname, s))
+          oie_fout.write('{}\t{}\n'.format(fname, triples_to_str(canned_triples(s))))
+          n_lines += 1
+  return {'docs': n_docs, 'lines': n_lines,
+          'sent_bytes': os.path.getsize(os.path.join(work_dir, 'corpus.sent')),
+          'oie_bytes': os.path.getsize(os.path.join(work_dir, 'corpus.oie'))}
+
+
+def json_files(args) -> List[str]:
+  json_dir = os.path.join(args.work_dir, 'pdf_json')
+  return sorted(os.path.join(json_dir, f) for f in os.listdir(json_dir))
+
+
+def read_lines(fname: str) -> List[str]:
+  with open(fname, 'r') as f:
+    return f.readlines()
+
+
+# Each benchmark returns the number of items it processed and the seconds it took, plus any other stats
+
+def bench_get_text(args) -> Dict:
+  from sentence_seg import get_text
+  files = json_files(args)
+  start, n_texts, n_chars = time.time(), 0, 0
+  for file in files:
+    with open(file, 'r') as fin:
+      for text in get_text(json.load(fin)):
+        n_texts += 1
+        n_chars += len(text)
+  return {'items': len(files), 'unit': 'docs', 'seconds': time.time() - start, 'paragraphs': n_texts, 'chars': n_chars}
+
+
+def bench_segmentation(args) -> Dict:
+  from sentence_seg import segment_file
+  files = json_files(args)
+  start, n_sents = time.time(), 0
+  for file in files:
+    _, _, sents = segment_file(file)
+    n_sents += sum(len(s) for s in sents)
+  return {'items': len(files), 'unit': 'docs', 'seconds': time.time() - start, 'sentences': n_sents}
+
+
+def bench_str_to_triples(args) -> Dict:
+  lines = [l.rstrip('\n').split('\t', 1)[1] for l in read_lines(os.path.join(args.work_dir, 'corpus.oie'))]
+  start, n_triples = time.time(), 0
+  for l in lines:
+    n_triples += len(str_to_triples(l))
+  return {'items': len(lines), 'unit': 'lines', 'seconds': time.time() - start, 'triples': n_triples}
+
+
+def bench_triples_to_str(args) -> Dict:
+  triples = [str_to_triples(l.rstrip('\n').split('\t', 1)[1]) for l in read_lines(os.path.join(args.work_dir, 'corpus.oie'))]
+  start = time.time()
+  for t in triples:
+    triples_to_str(t)
+  return {'items': len(triples), 'unit': 'lines', 'seconds': time.time() - start}
+
+
+def bench_template_matching(args) -> Dict:
+  with open(template_file, 'r') as f:
+    csvf = csv.reader(f)
+    next(csvf)
+    temp_data = list(csvf)
+  text_file, oie_file = os.path.join(args.work_dir, 'corpus.sent'), os.path.join(args.work_dir, 'corpus.oie')
+  start = time.time()
+  extractor = extract_from_templates.TemplateExtractor(temp_data)
+  extract_from_templates.extract_files(extractor, [text_file], [oie_file], args.workers)
+  seconds = time.time() - start
+  hits = extractor.store.take()
+  n_lines = sum(1 for _ in open(text_file, 'r'))
+  return {'items': n_lines, 'unit': 'lines', 'seconds': seconds, 'templates': len(temp_data), 'matches': len(hits),
+          'bytes': os.path.getsize(text_file) + os.path.getsize(oie_file)}
+
+
+def bench_query_format(args) -> Dict:
+  from index import ESSearcher
+  searcher = ESSearcher('bench')
+  queries = [l.rstrip('\n').split('\t', 1)[1] for l in read_lines(os.path.join(args.work_dir, 'corpus.sent'))]
+  start = time.time()
+  for q in queries:
+    searcher.query_format(q, 'sentence')
+  return {'items': len(queries), 'unit': 'queries', 'seconds': time.time() - start}
+
+
+def bench_oie_scheduler(args) -> Dict:
+  from oie_scheduler import ServerStats, annotate_chunks, read_chunks
+  clients = [CannedOpenIE(args.oie_latency) for _ in range(args.servers)]
+  start, n_sents = time.time(), 0
+  with open(os.path.join(args.work_dir, 'corpus.sent'), 'r') as fin:
+    for _, results, _ in annotate_chunks(clients, read_chunks(fin, 20000, 32 * 8), 32, 5, 15000, ServerStats()):
+      n_sents += len(results)
+  return {'items': n_sents, 'unit': 'sentences', 'seconds': time.time() - start, 'servers': args.servers,
+          'latency': args.oie_latency}
+
+
+benchmarks = {
+  'get_text': bench_get_text,
+  'segmentation': bench_segmentation,
+  'str_to_triples': bench_str_to_triples,
+  'triples_to_str': bench_triples_to_str,
+  'template_matching': bench_template_matching,
+  'query_format': bench_query_format,
+  'oie_scheduler': bench_oie_scheduler,
+}
+
+
+def peak_rss_mb() -> float:
+  # ru_maxrss is in KB on Linux and in bytes on macOS
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss / (1 << 20) if sys.platform == 'darwin' else rss / (1 << 10)
+
+
+def run_in_child(name: str, args, conn):
+  try:
+    base = peak_rss_mb()
+    best = None
+    for _ in range(args.repeat):
+      result = benchmarks[name](args)
+      if best is None or result['seconds'] < best['seconds']:
+        best = result
+    best['per_sec'] = best['items'] / max(best['seconds'], 1e-9)
+    if 'bytes' in best:
+      best['mb_per_sec'] = best['bytes'] / (1 << 20) / max(best['seconds'], 1e-9)
+    best['peak_rss_mb'] = peak_rss_mb()
+    best['rss_growth_mb'] = best['peak_rss_mb'] - base
+  except ImportError as e:
+    best = {'skipped': str(e)}
+  conn.send(best)
+  conn.close()
+
+
+def git_commit() -> str:
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the pipeline on a synthetic corpus')
+  parser.add_argument('--work_dir', type=str, required=True, help='Where to generate the corpus')
+  parser.add_argument('--docs', type=int, default=200, help='Number of documents to generate')
+  parser.add_argument('--paras', type=int, default=8, help='Number of paragraphs per document')
+  parser.add_argument('--sents', type=int, default=5, help='Average number of sentences per paragraph')
+  parser.add_argument('--seed', type=int, default=1, help='Seed of the corpus generator')
+  parser.add_argument('--only', type=str, nargs='+', choices=sorted(benchmarks), default=None, help='Which benchmarks to run (if not specified, all)')
+  parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each benchmark (the fastest is reported)')
+  parser.add_argument('--workers', type=int, default=1, help='Number of processes for template matching')
+  parser.add_argument('--servers', type=int, default=4, help='Number of canned OIE servers for the scheduler benchmark')
+  parser.add_argument('--oie_latency', type=float, default=0.0, help='Seconds each canned OIE request takes')
+  parser.add_argument('--out', type=str, default=None, help='The JSON file to write (default: stdout)')
+  args = parser.parse_args()
+
+  start = time.time()
+  corpus = generate_corpus(args.work_dir, args.docs, args.paras, args.sents, args.seed)
+  print('generated {} docs ({} sentences) in {:.1f}s'.format(corpus['docs'], corpus['lines'], time.time() - start), file=sys.stderr)
+
+  ctx = multiprocessing.get_context('fork')
+  results = {}
+  for name in args.only or benchmarks:
+    recv, send = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=run_in_child, args=(name, args, send))
+    p.start()
+    send.close()
+    try:
+      results[name] = recv.recv()
+    except EOFError:
+      results[name] = None
+    p.join()
+    if results[name] is None:
+      results[name] = {'failed': 'exit code {}'.format(p.exitcode)}
+    print('{}: {}'.format(name, ', '.join('{}={:.4g}'.format(k, v) if isinstance(v, float) else '{}={}'.format(k, v)
+                                          for k, v in results[name].items())), file=sys.stderr)
+
+  report = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'config': vars(args), 'corpus': corpus,
+            'benchmarks': results}
+  if args.out:
+    with open(args.out, 'w') as fout:
+      json.dump(report, fout, indent=2)
+  else:
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,177 @@
+'''
+Near-duplicate sentence elimination between sentence_seg.py and OIE/indexing.
+
+Sentences are clustered with MinHash/LSH over word 3-grams, and only the first sentence of each
+cluster (its representative) is written to <out>.sent. <out>.map lists every other member as
+"rep_line_id<TAB>src_file<TAB>src_line_id<TAB>paper_id", so that extraction over <out>.sent can still
+credit every paper a sentence came from (see extract_from_templates.py --dedup_maps).
+The output goes to a directory of its own, so that OIE and indexing (which take every .sent file of
+a directory) run on the representatives instead of on them and the originals.
+'''
+from typing import Iterable, List, Optional, Tuple
+from array import array
+from collections import Counter
+import argparse
+import itertools
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import zlib
+import numpy as np
+
+mersenne_prime = (1 << 61) - 1
+max_hash = (1 << 32) - 1
+
+
+def shingles(text: str, n: int = 3) -> List[str]:
+  toks = text.lower().split()
+  if len(toks) <= n:
+    return [' '.join(toks)]
+  return [' '.join(toks[i:i+n]) for i in range(len(toks) - n + 1)]
+
+
+class MinHasher:
+  def __init__(self, num_perm: int, seed: int = 1):
+    gen = np.random.RandomState(seed)
+    self.a = gen.randint(1, max_hash, size=num_perm, dtype=np.uint64)
+    self.b = gen.randint(0, max_hash, size=num_perm, dtype=np.uint64)
+
+  def signature(self, text: str) -> np.ndarray:
+    hashes = np.array([zlib.crc32(s.encode('utf-8')) for s in set(shingles(text))], dtype=np.uint64)
+    perms = ((np.outer(hashes, self.a) + self.b) % mersenne_prime) & max_hash
+    return perms.min(axis=0).astype(np.uint32)
+
+
+hasher = None
+def init_worker(num_perm: int):
+  global hasher
+  hasher = MinHasher(num_perm)
+
+
+def signatures(texts: List[str]) -> np.ndarray:
+  return np.stack([hasher.signature(text) for text in texts])
+
+
+class LSHIndex:
+  """The LSH buckets and the signatures of the representatives, in an sqlite file so memory use does not grow with the corpus.
+
+  Each band of a signature is hashed to an int64 key, and a bucket keeps the first representative added to it.
+  """
+
+  def __init__(self, path: str, bands: int, rows: int, cache_mb: int = 64):
+    self.bands = bands
+    # Odd multipliers of a linear hash of the rows of a band, modulo 2^64
+    self.mult = np.random.RandomState(1).randint(0, 1 << 62, size=rows, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    self.db = sqlite3.connect(path)
+    self.db.executescript('''
+      PRAGMA journal_mode = OFF;
+      PRAGMA synchronous = OFF;
+      PRAGMA cache_size = -{};
+      CREATE TABLE buckets (band INTEGER, key INTEGER, rep INTEGER, PRIMARY KEY (band, key)) WITHOUT ROWID;
+      CREATE TABLE sigs (rep INTEGER PRIMARY KEY, sig BLOB);'''.format(cache_mb * 1024))
+    # One statement for all the bands of a signature
+    self.find_sql = ' UNION ALL '.join('SELECT {0}, rep FROM buckets WHERE band = {0} AND key = ?'.format(band) for band in range(bands))
+    self.add_sql = 'INSERT OR IGNORE INTO buckets VALUES ' + ', '.join('({}, ?, ?)'.format(band) for band in range(bands))
+
+  def band_keys(self, sig: np.ndarray) -> List[int]:
+    return (sig.reshape(self.bands, -1) * self.mult).sum(axis=1).view(np.int64).tolist()
+
+  def find(self, sig: np.ndarray, keys: List[int], threshold: float) -> Optional[int]:
+    """The first representative in the buckets of the keys, in band order, that is similar enough to sig."""
+    checked = set()
+    for _, rep in sorted(self.db.execute(self.find_sql, keys).fetchall()):
+      if rep in checked:
+        continue
+      checked.add(rep)
+      rep_sig = np.frombuffer(self.db.execute('SELECT sig FROM sigs WHERE rep = ?', (rep,)).fetchone()[0], dtype=np.uint32)
+      if np.mean(rep_sig == sig) >= threshold:
+        return rep
+    return None
+
+  def add(self, rep: int, sig: np.ndarray, keys: List[int]):
+    self.db.execute('INSERT INTO sigs VALUES (?, ?)', (rep, sig.tobytes()))
+    self.db.execute(self.add_sql, [x for key in keys for x in (key, rep)])
+
+  def close(self):
+    self.db.close()
+
+
+def read_lines(files: List[str]) -> Iterable[Tuple[int, int, str, str]]:
+  for file_id, file in enumerate(files):
+    with open(file, 'r') as fin:
+      for line_id, line in enumerate(fin):
+        paper_id, text = line.rstrip('\n').split('\t', 1)
+        yield file_id, line_id, paper_id, text
+
+
+def chunked(it, size):
+  it = iter(it)
+  while True:
+    chunk = list(itertools.islice(it, size))
+    if not chunk:
+      return
+    yield chunk
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Keep one representative of each cluster of near-duplicate sentences')
+  parser.add_argument('inp', type=str, nargs='+', help='Input .sent files')
+  parser.add_argument('--out', type=str, required=True, help='Output prefix of the .sent and .map files')
+  parser.add_argument('--threshold', type=float, default=0.8, help='Min estimated Jaccard similarity of near-duplicates')
+  parser.add_argument('--num_perm', type=int, default=64, help='Number of MinHash permutations')
+  parser.add_argument('--bands', type=int, default=8, help='Number of LSH bands (num_perm must be divisible by it)')
+  parser.add_argument('--workers', type=int, default=1, help='Number of processes to compute signatures with')
+  args = parser.parse_args()
+  if args.num_perm % args.bands:
+    parser.error('--num_perm must be divisible by --bands')
+  out_dir = os.path.dirname(os.path.abspath(args.out))
+  if any(os.path.dirname(os.path.abspath(f)) == out_dir for f in args.inp):
+    parser.error('--out must be in another directory than the input files, or OIE would run on both')
+  os.makedirs(out_dir, exist_ok=True)
+
+  start = time.time()
+  init_worker(args.num_perm)
+  pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args.num_perm,)) if args.workers > 1 else None
+  # Only representatives are added to the LSH buckets, and their signatures are kept for verification
+  fd, lsh_path = tempfile.mkstemp(suffix='.db', dir=out_dir)
+  os.close(fd)
+  lsh = LSHIndex(lsh_path, args.bands, args.num_perm // args.bands)
+  cluster_sizes = array('i')
+  n_lines, n_chars, rep_chars = 0, 0, 0
+  with open(args.out + '.sent', 'w') as sent_fout, open(args.out + '.map', 'w') as map_fout:
+    for chunk in chunked(chunked(read_lines(args.inp), 1000), max(args.workers, 1) * 4):
+      texts = [[text for _, _, _, text in lines] for lines in chunk]
+      for lines, sigs in zip(chunk, pool.imap(signatures, texts) if pool else map(signatures, texts)):
+        for (file_id, line_id, paper_id, text), sig in zip(lines, sigs):
+          band_keys = lsh.band_keys(sig)
+          rep = lsh.find(sig, band_keys, args.threshold)
+          n_lines += 1
+          n_chars += len(text)
+          if rep is None:
+            rep = len(cluster_sizes)
+            cluster_sizes.append(1)
+            lsh.add(rep, sig, band_keys)
+            sent_fout.write('{}\t{}\n'.format(paper_id, text))
+            rep_chars += len(text)
+          else:
+            cluster_sizes[rep] += 1
+            map_fout.write('{}\t{}\t{}\t{}\n'.format(rep, args.inp[file_id], line_id, paper_id))
+  if pool:
+    pool.close()
+    pool.join()
+  lsh.close()
+  os.remove(lsh_path)
+
+  n_reps = len(cluster_sizes)
+  size_counts = Counter(min(s, 100) for s in cluster_sizes)
+  print('{} sentences in {} clusters in {:.1f}s'.format(n_lines, n_reps, time.time() - start), file=sys.stderr)
+  print('work saved: {:.1f}% of sentences, {:.1f}% of characters'.format(
+    100 * (1 - n_reps / max(n_lines, 1)), 100 * (1 - rep_chars / max(n_chars, 1))), file=sys.stderr)
+  print('cluster size\tclusters (100 means 100 or more)', file=sys.stderr)
+  for size, count in sorted(size_counts.items()):
+    print('{}\t{}'.format(size, count), file=sys.stderr)
+  if n_reps:
+    print('largest cluster: {}'.format(max(cluster_sizes)), file=sys.stderr)
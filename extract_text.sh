@@ -11,8 +11,9 @@ done
 
 # First, download the dataset and unzip it into new_raw_data
 # Need spacy for this
+workers=8
 mkdir -p new-text-only
 for dir in biorxiv_medrxiv comm_use_subset noncomm_use_subset custom_license; do
     echo ${dir}
-    python sentence_seg.py new_raw_data/${dir}/${dir}/pdf_json new-text-only/${dir}.txt new-text-only/${dir}.sent
+    python sentence_seg.py new_raw_data/${dir}/${dir}/pdf_json new-text-only/${dir}.txt new-text-only/${dir}.sent --workers ${workers}
 done
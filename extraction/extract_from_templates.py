@@ -1,12 +1,24 @@
 import argparse
 import csv
+import io
+import itertools
+import multiprocessing
 import os
 import re
 import shutil
 import sys
+import time
 import tqdm
 import json
-from collections import defaultdict
+from line_index import load_line_index
+from metadata_index import open_metadata_index
+from result_cache import ResultCache
+from result_store import TEXT, OIE, ResultBuffer, ResultStore, index_lines
+from shards import shard_file_pair
+from template_matcher import TemplateMatcher
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import profiling
+from profiling import profiler
 
 virus_names = ['COVID-19', 'Wuhan coronavirus', 'Wuhan seafood market pneumonia virus', 'SARS2', 'coronavirus disease 2019', 'SARS-CoV-2', '2019-nCoV']
 
@@ -14,6 +26,7 @@ virus_names = ['COVID-19', 'Wuhan coronavirus', 'Wuhan seafood market pneumonia
 #related_virus_names = ['betacoronaviruses', 'coronavirus', 'coronaviruses', 'PEDv', 'PEDV', 'coronaviridae', 'coronaviridae family', 'PED (virus)', 'MERS-CoV']
 
 oie_span_re = r'#[0-9]+,[0-9]+'
+oie_span_comp = re.compile(oie_span_re)
 
 def get_regexes(regex_str):
   regexes = []
@@ -28,127 +41,287 @@ def get_regexes(regex_str):
       regexes.append(f'{r}.*[X]')
   return regexes
 
-def page_head(title):
-  return f'<html><head><link rel="stylesheet" type="text/css" href="main.css"><title>{title}</title></head><body><h1>{title}</h1>'
+v_regex = '('+'|'.join(virus_names)+')'
+v_reg_comp = re.compile(v_regex)
 
-metadata = {}
-def print_results_table(f, title, records, data):
-  if not records: return
-  print(f'<h2>{title}</h2><table>', file=f)
-  res = sorted(list(records.items()), key=lambda x: -len(x[1]))
-  for k, v in res:
-    l = len(v)
-    print(f'<tr><th>{k} {data[5]} (count: {l})</th></tr>', file=f)
-    for text, (fid, lid, sha) in v.items():
-      if sha in metadata:
-        md = metadata[sha]
-        source = md[10] if md[10] else md[1]
-        md_text = f'-- <a href="https://doi.org/{md[3]}"><b>{md[2]}</b></a>. {source}. {md[8]}.'
+class TemplateExtractor:
+  """Match every template against aligned text/OIE lines and collect the results.
+
+  All templates are compiled once, and a `TemplateMatcher` over the literals required by each
+  template picks the few candidates for each line so only those run the full regex.
+  """
+
+  def __init__(self, temp_data, store=None, template_ids=None):
+    """
+    :param store: where the matches go, a `ResultStore` or by default a `ResultBuffer`
+    :param template_ids: the id of each template in the store, if temp_data is a subset of the templates
+    """
+    self.temp_data = temp_data
+    self.store = store if store is not None else ResultBuffer()
+    self.template_ids = template_ids if template_ids is not None else list(range(len(temp_data)))
+    self.text_regexes, self.oie_regexes = [], []
+    text_templates, oie_templates = [], []
+    for i, my_data in enumerate(temp_data):
+      # Text extraction
+      regexes = get_regexes(my_data[4])
+      if not len(regexes):
+        self.text_regexes.append(None)
+        text_templates.append(None)
       else:
-        md_text = '-- reference not found!'
-      print(f'<tr><td colspan=2>{text}<br/><div class="ref">{md_text}</div></td></tr>', file=f)
-  print('</table>', file=f)
+        text_templates.append(regexes)
+        regexes = [x.replace('[X]', v_regex).replace('[Y]', f'(?P<G{i}>.*?)') for (i,x) in enumerate(regexes)]
+        regex_cnt = len(regexes)
+        regexes = '('+'|'.join(regexes)+')'
+        self.text_regexes.append( (re.compile(regexes), regex_cnt, my_data[6]) )
+      # OIE regexes
+      regexes = get_regexes(my_data[3])
+      if not len(regexes) or not len(regexes[0]):
+        self.oie_regexes.append(None)
+        oie_templates.append(None)
+      else:
+        oie_templates.append(regexes)
+        regexes = [x.replace('[X]', v_regex).replace('[B]', '\\|\\|\\|') for (i,x) in enumerate(regexes)]
+        regexes = '('+'|'.join(regexes)+')'
+        self.oie_regexes.append( re.compile(regexes) )
+    self.text_matcher = TemplateMatcher(text_templates)
+    self.oie_matcher = TemplateMatcher(oie_templates)
+    if profiler.enabled:
+      for i, my_data in zip(self.template_ids, temp_data):
+        profiler.label(f'template {i}', 'question', my_data[2])
 
-if __name__ == "__main__":
+  def process_line(self, file_id, line_id, text_line, oie_line, text_offset=-1):
+    """:param text_offset: the byte offset of the line in its text file if known, to read it back when rendering"""
+    prof = profiler if profiler.enabled else None
+    if prof: prof.stage('template matching', 1, len(text_line) + len(oie_line))
+    if not v_reg_comp.search(text_line): return
+    text_split = text_line.split('\t')
+    text_line = '\t'.join(text_split[1:])
+    for text_id in self.text_matcher.candidates(text_line):
+      if prof: start = time.perf_counter()
+      text_rex_re, text_rex_cnt, text_rex_type = self.text_regexes[text_id]
+      m = text_rex_re.search(text_line)
+      if prof:
+        row = f'template {self.template_ids[text_id]}'
+        prof.add(row, 'text_seconds', time.perf_counter() - start)
+        prof.add(row, 'text_candidates')
+        prof.add(row, 'text_matches', 1 if m else 0)
+      if m:
+        if text_rex_type == 'yonly':
+          vals = [m.group(f'G{i}') for i in range(text_rex_cnt)]
+          vals = [x for x in vals if x is not None]
+          assert(len(vals) == 1)
+          key = vals[0]
+        else:
+          key = m.group(1)
+        self.store.add(self.template_ids[text_id], TEXT, key, text_line, file_id, line_id, text_offset)
+    oie_line = oie_span_comp.sub('', oie_line)
+    extractions = oie_line.split('\t')[1:]
+    for text_id in self.oie_matcher.candidates(oie_line):
+      if prof: start = time.perf_counter()
+      oie_rex = self.oie_regexes[text_id]
+      # Use a heuristic of only keeping the shortest extraction that matches
+      best_extraction = None
+      for extraction in extractions:
+        m = oie_rex.search(extraction)
+        if m:
+          key = extraction.strip().replace('|||', ' | ')
+          if not best_extraction or len(best_extraction[0]) > len(key):
+            best_extraction = (key, text_line)
+      if prof:
+        row = f'template {self.template_ids[text_id]}'
+        prof.add(row, 'oie_seconds', time.perf_counter() - start)
+        prof.add(row, 'oie_candidates')
+        prof.add(row, 'oie_extractions_scanned', len(extractions))
+        prof.add(row, 'oie_matches', 1 if best_extraction else 0)
+      if best_extraction:
+        (key, linet) = best_extraction
+        self.store.add(self.template_ids[text_id], OIE, key, linet, file_id, line_id, text_offset)
 
-  parser = argparse.ArgumentParser(description='Extract data from text/OIE extractions')
-  parser.add_argument('--template_file', required=True, type=str, default='cord19-templates.csv', help='input file')
-  parser.add_argument('--text_files', type=str, nargs='+', required=True, help='Text files')
-  parser.add_argument('--oie_files', type=str, nargs='+', required=True, help='OpenIE extractions')
-  parser.add_argument('--html_dir', type=str, required=True, help='The directory where we output files')
-  parser.add_argument('--tasks', type=int, nargs='+', default=None, help='Which tasks to do (if not specified, all)')
-  parser.add_argument('--raw_data_dir', type=str, help='A link to the raw data JSON files')
+  def merge(self, hits, profile=None):
+    """Merge the matches (and profile) of a worker. Merging shards in file/line order gives the same results as the serial path."""
+    self.store.add_hits(hits)
+    profiler.merge(profile)
 
-  args = parser.parse_args()
-  if args.oie_files and len(args.oie_files) != len(args.text_files):
-    raise ValueError('Lengths of the args.oie_files and args.text_files arguments must be the same')
+shard_extractor = None
+def init_shard_worker(temp_data, template_ids):
+  global shard_extractor
+  # Do not send back what the parent had recorded before the worker was forked
+  profiler.take()
+  shard_extractor = TemplateExtractor(temp_data, template_ids=template_ids)
 
-  with open(f'{args.raw_data_dir}/metadata.csv', 'r') as f:
-    csvf = csv.reader(f)
-    text_header = next(csvf)
-    for line in csvf:
-      metadata[line[0]] = line
+def lines_with_offsets(f, offset=0):
+  """Yield the byte offset of each line of a file opened with newline='', and the line as text mode reads it."""
+  for line in f:
+    yield offset, line[:-2] + '\n' if line.endswith('\r\n') else line[:-1] + '\n' if line.endswith('\r') else line
+    offset += len(line.encode(f.encoding))
 
-  with open(args.template_file, 'r') as f:
-    csvf = csv.reader(f)
-    text_header = next(csvf)
-    temp_data = list(csvf)
-    if args.tasks is not None:
-      temp_data = [temp_data[i] for i in args.tasks]
+def extract_shard(shard):
+  """Process a single shard in a worker and return its matches and profile."""
+  file_id, text_fname, oie_fname, (line_id, line_cnt, text_start, oie_start) = shard
+  extractor = shard_extractor
+  with open(text_fname, 'rb') as text_b, open(oie_fname, 'rb') as oie_b:
+    text_b.seek(text_start)
+    oie_b.seek(oie_start)
+    text_f, oie_f = io.TextIOWrapper(text_b, newline=''), io.TextIOWrapper(oie_b)
+    lines = zip(lines_with_offsets(text_f, text_start), oie_f)
+    for i, ((text_offset, text_line), oie_line) in enumerate(itertools.islice(lines, line_cnt)):
+      extractor.process_line(file_id, line_id + i, text_line, oie_line, text_offset)
+  return extractor.store.take(), profiler.take() if profiler.enabled else None
 
-  # Create regexes
-  text_regexes, oie_regexes = [], []
-  v_regex = '('+'|'.join(virus_names)+')'
-  v_reg_comp = re.compile(v_regex)
-  for i, my_data in enumerate(temp_data):
-    # Text extraction
-    orig_regexes = my_data[4].split('\n')
-    regexes = get_regexes(my_data[4])
-    if not len(regexes):
-      text_regexes.append(None)
-    else:
-      regexes = [x.replace('[X]', v_regex).replace('[Y]', f'(?P<G{i}>.*?)') for (i,x) in enumerate(regexes)]
-      regex_cnt = len(regexes)
-      regexes = '('+'|'.join(regexes)+')'
-      text_regexes.append( (re.compile(regexes), regex_cnt, my_data[6]) )
-    # OIE regexes
-    regexes = get_regexes(my_data[3])
-    if not len(regexes) or not len(regexes[0]):
-      oie_regexes.append(None)
+def extract_lines(extractor, file_id, text_fname, oie_fname, entries):
+  """Process only the lines in a flat array of (line id, text offset, OIE offset) triples from `load_line_index`."""
+  with open(text_fname, 'r') as text_f, open(oie_fname, 'r') as oie_f:
+    for i in range(0, len(entries), 3):
+      line_id, text_off, oie_off = entries[i:i+3]
+      text_f.seek(text_off)
+      oie_f.seek(oie_off)
+      extractor.process_line(file_id, line_id, text_f.readline(), oie_f.readline(), text_off)
+
+def extract_indexed(chunk):
+  """Process a chunk of indexed lines in a worker and return its matches and profile."""
+  extractor = shard_extractor
+  extract_lines(extractor, *chunk)
+  return extractor.store.take(), profiler.take() if profiler.enabled else None
+
+def match_lines(lines):
+  """Process a list of (file id, line id, text line, OIE line) in a worker and return its matches and profile."""
+  extractor = shard_extractor
+  for line in lines:
+    extractor.process_line(*line)
+  return extractor.store.take(), profiler.take() if profiler.enabled else None
+
+def extract_files(extractor, text_files, oie_files, workers=1, virus_index=False):
+  """Run the extractor over aligned text/OIE files, in a pool of processes if workers > 1.
+
+  With virus_index, only the lines mentioning the virus are read, by seeking to their offsets in a
+  sidecar index next to each text file, which is (re)built first if it is missing or stale.
+  """
+  if virus_index:
+    chunks = []
+    for file_id, (text_fname, oie_fname) in enumerate(zip(text_files, oie_files)):
+      print(f'Loading the line index of {text_fname} and {oie_fname}', file=sys.stderr)
+      entries = load_line_index(v_regex, text_fname, oie_fname)
+      chunk_len = 3 * max(1, -(-len(entries) // 3 // (workers * 4)))
+      chunks += [(file_id, text_fname, oie_fname, entries[i:i+chunk_len]) for i in range(0, len(entries), chunk_len)]
+    if workers > 1:
+      with multiprocessing.Pool(workers, initializer=init_shard_worker, initargs=(extractor.temp_data, extractor.template_ids)) as pool:
+        for partial in tqdm.tqdm(pool.imap(extract_indexed, chunks), total=len(chunks)):
+          extractor.merge(*partial)
     else:
-      regexes = [x.replace('[X]', v_regex).replace('[B]', '\\|\\|\\|') for (i,x) in enumerate(regexes)]
-      regexes = '('+'|'.join(regexes)+')'
-      oie_regexes.append( re.compile(regexes) )
+      for chunk in tqdm.tqdm(chunks):
+        extract_lines(extractor, *chunk)
+  elif workers > 1:
+    shards = []
+    for file_id, (text_fname, oie_fname) in enumerate(zip(text_files, oie_files)):
+      print(f'Sharding {text_fname} and {oie_fname}', file=sys.stderr)
+      shards += [(file_id, text_fname, oie_fname, x) for x in shard_file_pair(text_fname, oie_fname, workers * 4)]
+    with multiprocessing.Pool(workers, initializer=init_shard_worker, initargs=(extractor.temp_data, extractor.template_ids)) as pool:
+      for partial in tqdm.tqdm(pool.imap(extract_shard, shards), total=len(shards)):
+        extractor.merge(*partial)
+  else:
+    for file_id, (text_fname, oie_fname) in enumerate(zip(text_files, oie_files)):
+      print(f'Processing {text_fname} and {oie_fname}', file=sys.stderr)
+      with open(text_fname, 'r', newline='') as text_f, open(oie_fname, 'r') as oie_f:
+        for line_id, ((text_offset, text_line), oie_line) in tqdm.tqdm(enumerate(zip(lines_with_offsets(text_f), oie_f))):
+          extractor.process_line(file_id, line_id, text_line, oie_line, text_offset)
 
-  # This is using a dictionary to store the results to de-duplicate lines
-  text_recounts = [defaultdict(lambda: {}) for _ in text_regexes]
-  oie_recounts = [defaultdict(lambda: {}) for _ in oie_regexes]
+def page_head(title):
+  return f'<html><head><link rel="stylesheet" type="text/css" href="main.css"><title>{title}</title></head><body><h1>{title}</h1>'
 
-  json_data = {}
+metadata = {}
+def reference_html(sha):
+  md = metadata.get(sha)
+  if md:
+    source = md['journal'] if md['journal'] else md['source_x']
+    return f'-- <a href="https://doi.org/{md["doi"]}"><b>{md["title"]}</b></a>. {source}. {md["publish_time"]}.'
+  else:
+    return '-- reference not found!'
 
-  # Process text and OIE extractions
-  lines = []
-  for file_id, (text_fname, oie_fname) in enumerate(zip(args.text_files, args.oie_files)):
-    print(f'Processing {text_fname} and {oie_fname}', file=sys.stderr)
-    with open(text_fname, 'r') as text_f, open(oie_fname, 'r') as oie_f:
-      for line_id, (text_line, oie_line) in tqdm.tqdm(enumerate(zip(text_f, oie_f))):
-        if not re.search(v_reg_comp, text_line): continue
-        text_split = text_line.split('\t')
-        sha_hash = text_split[0].split('/')[-1][:-5]
-        text_line = '\t'.join(text_split[1:])
-        extractions = re.sub(oie_span_re, '', oie_line).split('\t')[1:]
-        for text_id, (text_rex, text_rec, oie_rex, oie_rec) in enumerate(zip(text_regexes, text_recounts, oie_regexes, oie_recounts)):
-          if text_rex:
-            text_rex_re, text_rex_cnt, text_rex_type = text_rex
-            m = re.search(text_rex_re, text_line)
-            if m:
-              if text_rex_type == 'yonly':
-                vals = [m.group(f'G{i}') for i in range(text_rex_cnt)]
-                vals = [x for x in vals if x is not None]
-                assert(len(vals) == 1)
-                key = vals[0]
-              else:
-                key = m.group(1)
-              text_rec[key][text_line] = (file_id,line_id,sha_hash)
-          if oie_rex:
-            # Use a heuristic of only keeping the shortest extraction that matches
-            best_extraction = None
-            for extraction in extractions:
-              m = re.search(oie_rex, extraction)
-              if m:
-                key = extraction.strip().replace('|||', ' | ')
-                if not best_extraction or len(best_extraction[0]) > len(key):
-                  best_extraction = (key, text_line, file_id, line_id)
-            if best_extraction:
-              (key, linet, file_id, line_id) = best_extraction
-              oie_rec[key][linet] = (file_id,line_id,sha_hash)
-
-  if not os.path.exists(args.html_dir):
-      os.makedirs(args.html_dir)
-  shutil.copy2('main.css', f'{args.html_dir}/main.css')
-  shutil.copy2('lti.png', f'{args.html_dir}/lti.png')
-
-  with open(f'{args.html_dir}/index.html', 'w') as findex:
+# (file_id, line_id) of a representative sentence -> papers with a near-duplicate of it (see dedup_sents.py)
+dedup_sources = {}
+max_dedup_refs = 20
+def load_dedup_map(file_id, fname):
+  with open(fname, 'r') as f:
+    for line in f:
+      rep_id, _, _, paper_id = line.rstrip('\n').split('\t')
+      shas = dedup_sources.setdefault((file_id, int(rep_id)), [])
+      sha = paper_id.split('/')[-1][:-5]
+      if sha not in shas:
+        shas.append(sha)
+
+def result_html(store, lines, i, kind, key_id, key, count, data, max_per_key):
+  """The rows of a key, with the first max_per_key of its sentences read from their files."""
+  rows = [f'<tr><th>{key} {data[5]} (count: {count})</th></tr>']
+  for fid, lid in store.refs(i, kind, key_id, max_per_key):
+    text_split = lines.line(fid, lid).split('\t')
+    sha = text_split[0].split('/')[-1][:-5]
+    text = '\t'.join(text_split[1:])
+    md_text = reference_html(sha)
+    others = [x for x in dedup_sources.get((fid, lid), []) if x != sha]
+    for other in others[:max_dedup_refs]:
+      md_text += '<br/>' + reference_html(other)
+    if len(others) > max_dedup_refs:
+      md_text += f'<br/>-- and {len(others) - max_dedup_refs} more papers'
+    rows.append(f'<tr><td colspan=2>{text}<br/><div class="ref">{md_text}</div></td></tr>')
+  if count > max_per_key:
+    rows.append(f'<tr><td colspan=2>-- and {count - max_per_key} more sentences</td></tr>')
+  return '\n'.join(rows)
+
+def page_fname(i, page):
+  return f'report-{i}.html' if page == 0 else f'report-{i}-{page + 1}.html'
+
+def write_report(html_dir, i, data, store, lines, counts, page_size, max_per_key):
+  """Write the report of a template, streaming its keys from the store into pages of up to page_size keys."""
+  n_pages = max(1, -(-sum(counts) // page_size))
+  def nav(page):
+    links = [f'<a href="{page_fname(i, p)}">{p + 1}</a>' if p != page else f'<b>{p + 1}</b>' for p in range(n_pages)]
+    return f'<p>Page {" ".join(links)}</p>'
+  f, page, n_keys, table = None, -1, 0, None
+  def open_page():
+    f = open(f'{html_dir}/{page_fname(i, page)}', 'w')
+    print(page_head(data[2]), file=f)
+    print('<p><a href="index.html">&lt;&lt; Back to Top</a></p>', file=f)
+    if n_pages > 1:
+      print(nav(page), file=f)
+    return f
+  def close_page(f):
+    if table:
+      print('</table>', file=f)
+    if n_pages > 1:
+      print(nav(page), file=f)
+    print('</body></html>', file=f)
+    f.close()
+  for title, kind in (('Textual Template Results', TEXT), ('Information Extraction Results', OIE)):
+    for key_id, key, count in store.iter_keys(i, kind):
+      if f is None or n_keys == page_size:
+        if f is not None:
+          close_page(f)
+        page, n_keys, table = page + 1, 0, None
+        f = open_page()
+      if table != title:
+        if table:
+          print('</table>', file=f)
+        print(f'<h2>{title}</h2><table>', file=f)
+        table = title
+      print(result_html(store, lines, i, kind, key_id, key, count, data, max_per_key), file=f)
+      n_keys += 1
+  if f is None:
+    page = 0
+    f = open_page()
+  close_page(f)
+
+def write_reports(html_dir, temp_data, text_regexes, oie_regexes, store, lines, page_size=200, max_per_key=100):
+  """Write the index page and the report pages of every template with the results collected so far.
+
+  :param store: the `ResultStore` with the results
+  :param lines: a `LineReader` for the sentences the results refer to
+  """
+  if not os.path.exists(html_dir):
+    os.makedirs(html_dir)
+  shutil.copy2(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.css'), f'{html_dir}/main.css')
+  shutil.copy2(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lti.png'), f'{html_dir}/lti.png')
+
+  with open(f'{html_dir}/index.html', 'w') as findex:
     print(page_head('CORD-19 Information Aggregator'), file=findex)
     print('<p><div class="ref">by <a href="http://phontron.com">Graham Neubig</a>, '
           '<a href="https://people.cs.umass.edu/~strubell/">Emma Strubell</a>, '
@@ -163,20 +336,87 @@ if __name__ == "__main__":
           'and could give fine-grained feedback please contact us at <tt>gneubig@cs.cmu.edu</tt>. If you want to '
           'contribute to the code base you can do it through <a href="https://www.github.com/neulab/cord19">github</a>.</p>', file=findex)
     print('<hr/><h2>Browse Questions</h2>', file=findex)
-    num_results = [(len(text_recounts[i]) if text_recounts[i] else 0) + (len(oie_recounts[i]) if oie_recounts[i] else 0) for i in range(len(temp_data))]
-    order = sorted(list(range(len(temp_data))), key=lambda i: -num_results[i])
+    counts = [(store.count_keys(i, TEXT), store.count_keys(i, OIE)) for i in range(len(temp_data))]
+    order = sorted(list(range(len(temp_data))), key=lambda i: -sum(counts[i]))
     for i in order:
-      temp_d, text_rex, text_rec, oie_rex, oie_rec = [x[i] for x in (temp_data, text_regexes, text_recounts, oie_regexes, oie_recounts)]
-      if text_rex or oie_rex:
-        fname = f'report-{i}.html'
-        l = (len(text_rec) if text_rec else 0) + (len(oie_rec) if oie_rec else 0)
-        print(f'<li><a href="{fname}">{temp_d[2]}</a> ({l} results)</li>', file=findex)
-        with open(f'{args.html_dir}/{fname}', 'w') as f:
-          print(page_head(temp_d[2]), file=f)
-          print('<p><a href="index.html">&lt;&lt; Back to Top</a></p>', file=f)
-          print_results_table(f, 'Textual Template Results', text_rec, temp_d)
-          print_results_table(f, 'Information Extraction Results', oie_rec, temp_d)
-          print('</body></html>', file=f)
+      if text_regexes[i] or oie_regexes[i]:
+        print(f'<li><a href="{page_fname(i, 0)}">{temp_data[i][2]}</a> ({sum(counts[i])} results)</li>', file=findex)
+        write_report(html_dir, i, temp_data[i], store, lines, counts[i], page_size, max_per_key)
     print('</ul>', file=findex)
     print('<hr/><p>Gratefully built on data from the <a href="https://www.kaggle.com/allen-institute-for-ai/CORD-19-research-challenge">CORD-19 dataset</a>.</p>', file=findex)
     print('<center><a href="http://lti.cs.cmu.edu"><img src="lti.png" height="100"></a></center></body></html>', file=findex)
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description='Extract data from text/OIE extractions')
+  parser.add_argument('--template_file', required=True, type=str, default='cord19-templates.csv', help='input file')
+  parser.add_argument('--text_files', type=str, nargs='+', required=True, help='Text files')
+  parser.add_argument('--oie_files', type=str, nargs='+', required=True, help='OpenIE extractions')
+  parser.add_argument('--html_dir', type=str, required=True, help='The directory where we output files')
+  parser.add_argument('--tasks', type=int, nargs='+', default=None, help='Which tasks to do (if not specified, all)')
+  parser.add_argument('--raw_data_dir', type=str, help='A link to the raw data JSON files')
+  parser.add_argument('--metadata_index', type=str, default=None, help='The metadata index to use, built from metadata.csv if needed (default: metadata.db in raw_data_dir)')
+  parser.add_argument('--dedup_maps', type=str, nargs='+', default=None, help='The .map file of each text file that was deduplicated with dedup_sents.py')
+  parser.add_argument('--cache_dir', type=str, default=None, help='A directory to cache the results of each template in, so only changed templates are re-extracted')
+  parser.add_argument('--workers', type=int, default=1, help='Number of processes to extract with (each file is split into shards)')
+  parser.add_argument('--result_store', type=str, default=None, help='The sqlite file to collect the results in (default: a temporary file)')
+  parser.add_argument('--memory_budget', type=int, default=1000000, help='Number of results kept in memory before they are written to the result store')
+  parser.add_argument('--page_size', type=int, default=200, help='Number of results on each report page')
+  parser.add_argument('--max_per_key', type=int, default=100, help='Number of sentences shown for each result')
+  parser.add_argument('--profile', type=str, default=None, help='Write a profile of each template to this .json or .csv file')
+  parser.add_argument('--profile_every', type=float, default=0, help='Also write the profile every this many seconds')
+  parser.add_argument('--virus_index', action='store_true', help='Only read the lines that mention the virus, using an index of their offsets stored next to each text file (<text_file>.vidx)')
+
+  args = parser.parse_args()
+  if args.profile:
+    profiling.enable(args.profile, args.profile_every)
+  if args.oie_files and len(args.oie_files) != len(args.text_files):
+    raise ValueError('Lengths of the args.oie_files and args.text_files arguments must be the same')
+  if args.dedup_maps and len(args.dedup_maps) != len(args.text_files):
+    raise ValueError('Lengths of the args.dedup_maps and args.text_files arguments must be the same')
+
+  metadata = open_metadata_index(f'{args.raw_data_dir}/metadata.csv', args.metadata_index or f'{args.raw_data_dir}/metadata.db')
+
+  for file_id, fname in enumerate(args.dedup_maps or []):
+    load_dedup_map(file_id, fname)
+
+  with open(args.template_file, 'r') as f:
+    csvf = csv.reader(f)
+    text_header = next(csvf)
+    temp_data = list(csvf)
+    if args.tasks is not None:
+      temp_data = [temp_data[i] for i in args.tasks]
+
+  store = ResultStore(args.result_store, args.memory_budget)
+  extractor = TemplateExtractor(temp_data, store)
+  text_regexes, oie_regexes = extractor.text_regexes, extractor.oie_regexes
+
+  # Process text and OIE extractions
+  if args.cache_dir:
+    # Only templates without cached results for these input files need to scan the corpus
+    cache = ResultCache(args.cache_dir, args.text_files, args.oie_files)
+    keys = [cache.key(text_rex, oie_rex) for text_rex, oie_rex in zip(text_regexes, oie_regexes)]
+    todo, n_cached = [], 0
+    for i, key in enumerate(keys):
+      if not (text_regexes[i] or oie_regexes[i]): continue
+      cached = cache.load(key)
+      if cached is not None:
+        # The same template may have another index with other --tasks
+        store.add_hits((i,) + tuple(hit[1:]) for hit in cached)
+        n_cached += 1
+      else:
+        todo.append(i)
+    print(f'Extracting {len(todo)} templates ({n_cached} cached)', file=sys.stderr)
+    if todo:
+      todo_extractor = TemplateExtractor([temp_data[i] for i in todo], store, todo)
+      extract_files(todo_extractor, args.text_files, args.oie_files, args.workers, args.virus_index)
+      for i in todo:
+        cache.save(keys[i], store.export(i))
+  else:
+    extract_files(extractor, args.text_files, args.oie_files, args.workers, args.virus_index)
+
+  # Only the sentences of the results are read back, by seeking to the offsets found while extracting
+  lines = index_lines(args.text_files, store.all_refs())
+  write_reports(args.html_dir, temp_data, text_regexes, oie_regexes, store, lines, args.page_size, args.max_per_key)
+  lines.close()
+  store.close()
@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import re
+from array import array
+from typing import Iterator, Tuple
+import tqdm
+
+line_re = re.compile(rb'([^\r\n]*)(\r\n|\r|\n)?')
+
+
+def iter_line_offsets(fname: str) -> Iterator[Tuple[int, bytes]]:
+  """Yield the byte offset and content of every line, splitting lines like a file opened in text mode."""
+  base = 0
+  with open(fname, 'rb') as f:
+    for raw in f:
+      for m in line_re.finditer(raw):
+        if not m.group(1) and not m.group(2):
+          break
+        yield base + m.start(), m.group(1)
+      base += len(raw)
+
+
+def _fingerprint(fname: str):
+  st = os.stat(fname)
+  return [st.st_size, st.st_mtime_ns]
+
+
+def _header(pattern: str, text_fname: str, oie_fname: str):
+  return {'pattern': hashlib.sha1(pattern.encode('utf-8')).hexdigest(),
+          'text': _fingerprint(text_fname), 'oie': _fingerprint(oie_fname)}
+
+
+def build_line_index(pattern: str, text_fname: str, oie_fname: str, index_fname: str) -> array:
+  """Find the lines of the text file that match pattern, and their byte offsets in the text and OIE files.
+
+  The index is stored as a JSON header line followed by (line id, text offset, OIE offset) int64 triples.
+  """
+  header = _header(pattern, text_fname, oie_fname)
+  pattern_comp = re.compile(pattern.encode('utf-8'))
+  entries = array('q')
+  for line_id, ((text_off, text_line), (oie_off, _)) in tqdm.tqdm(enumerate(zip(iter_line_offsets(text_fname), iter_line_offsets(oie_fname)))):
+    if pattern_comp.search(text_line):
+      entries.extend((line_id, text_off, oie_off))
+  tmp_fname = index_fname + '.tmp'
+  with open(tmp_fname, 'wb') as f:
+    f.write((json.dumps(header) + '\n').encode('utf-8'))
+    entries.tofile(f)
+  os.replace(tmp_fname, index_fname)
+  return entries
+
+
+def load_line_index(pattern: str, text_fname: str, oie_fname: str, index_fname: str = None) -> array:
+  """Load the index of the lines that match pattern, rebuilding it if the pattern or either file changed.
+
+  :return: a flat array of (line id, text offset, OIE offset) triples.
+  """
+  index_fname = index_fname or text_fname + '.vidx'
+  if os.path.exists(index_fname):
+    with open(index_fname, 'rb') as f:
+      try:
+        header = json.loads(f.readline().decode('utf-8'))
+      except ValueError:
+        header = None
+      if header == _header(pattern, text_fname, oie_fname):
+        entries = array('q')
+        entries.frombytes(f.read())
+        return entries
+  return build_line_index(pattern, text_fname, oie_fname, index_fname)
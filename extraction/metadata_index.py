@@ -0,0 +1,78 @@
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+from functools import lru_cache
+from typing import Dict, Optional
+
+# The metadata.csv columns rendered in the reports
+fields = ['title', 'doi', 'source_x', 'journal', 'publish_time']
+
+
+def build_metadata_index(metadata_file: str, index_file: str):
+  """Build an sqlite index mapping every paper sha and PMC id in metadata.csv to the fields we render.
+
+  Columns are looked up by name, since their positions change between CORD-19 releases, and a `sha`
+  column with several `;`-separated hashes gets an entry for each of them.
+  """
+  csv.field_size_limit(sys.maxsize)
+  tmp_file = index_file + '.tmp'
+  if os.path.exists(tmp_file):
+    os.remove(tmp_file)
+  db = sqlite3.connect(tmp_file)
+  db.execute(f'CREATE TABLE metadata (key TEXT PRIMARY KEY, {", ".join(fields)})')
+  with open(metadata_file, 'r') as f:
+    csvf = csv.DictReader(f)
+    rows = []
+    for line in csvf:
+      values = [line.get(x) or '' for x in fields]
+      keys = [x.strip() for x in (line.get('sha') or '').split(';')] + [(line.get('pmcid') or '').strip()]
+      rows.extend([key] + values for key in keys if key)
+      if len(rows) >= 10000:
+        db.executemany(f'INSERT OR IGNORE INTO metadata VALUES (?{", ?" * len(fields)})', rows)
+        rows = []
+    db.executemany(f'INSERT OR IGNORE INTO metadata VALUES (?{", ?" * len(fields)})', rows)
+  db.commit()
+  db.close()
+  os.replace(tmp_file, index_file)
+
+
+class MetadataIndex:
+  """Lazy lookups of paper metadata by sha or PMC id in an index built by `build_metadata_index`."""
+
+  def __init__(self, index_file: str):
+    self.db = sqlite3.connect(index_file)
+
+  @lru_cache(maxsize=100000)
+  def get(self, key: str) -> Optional[Dict[str, str]]:
+    # Papers parsed from PMC XML are named like PMC12345.xml.json
+    if key.endswith('.xml'):
+      key = key[:-4]
+    row = self.db.execute(f'SELECT {", ".join(fields)} FROM metadata WHERE key = ?', (key,)).fetchone()
+    return dict(zip(fields, row)) if row else None
+
+  def __contains__(self, key: str) -> bool:
+    return self.get(key) is not None
+
+  def __getitem__(self, key: str) -> Dict[str, str]:
+    md = self.get(key)
+    if md is None:
+      raise KeyError(key)
+    return md
+
+
+def open_metadata_index(metadata_file: str, index_file: str) -> MetadataIndex:
+  """Open the index, (re)building it first if it is missing or older than metadata.csv."""
+  if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(metadata_file):
+    print(f'Building metadata index {index_file}', file=sys.stderr)
+    build_metadata_index(metadata_file, index_file)
+  return MetadataIndex(index_file)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Build an index of the CORD-19 metadata for the reports')
+  parser.add_argument('--metadata_file', type=str, required=True, help='metadata.csv of a CORD-19 release')
+  parser.add_argument('--index_file', type=str, required=True, help='The sqlite file to write')
+  args = parser.parse_args()
+  build_metadata_index(args.metadata_file, args.index_file)
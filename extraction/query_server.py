@@ -0,0 +1,165 @@
+'''
+Interactive template queries over the corpus, for developing templates without rerunning the extraction.
+
+The lines of the text and OIE files that mention the virus (the only ones a template can match, see
+line_index.py) are indexed by trigram once at startup. A query is a template in the syntax of
+cord19-templates.csv: its text and OIE regexes only run on the lines that contain the trigrams of
+their required literals, and the answers are grouped by key like in the reports. Queries are
+answered over HTTP, or once from the command line with --text/--oie.
+
+  curl 'localhost:8000/query?text=incubation+period+of+[X]+is+[Y]+days&type=yonly'
+'''
+from array import array
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+import argparse
+import itertools
+import json
+import re
+import sys
+import time
+import tqdm
+from extract_from_templates import TemplateExtractor, get_regexes, oie_span_comp, v_regex
+from line_index import load_line_index
+from metadata_index import open_metadata_index
+from result_store import TEXT, OIE, LineReader, ResultStore
+from trigram_index import TrigramIndex
+
+
+class QueryIndex:
+  """Trigram indexes of the sentences and OIE extractions of the lines that mention the virus."""
+
+  def __init__(self, text_files: List[str], oie_files: List[str], metadata=None):
+    self.metadata = metadata if metadata is not None else {}
+    self.text_lines, self.oie_lines = LineReader(text_files), LineReader(oie_files)
+    # The (file id, line id) of each document of the indexes
+    self.file_ids, self.line_ids = array('i'), array('q')
+    self.text_index, self.oie_index = TrigramIndex(), TrigramIndex()
+    for file_id, (text_fname, oie_fname) in enumerate(zip(text_files, oie_files)):
+      entries = load_line_index(v_regex, text_fname, oie_fname)
+      self.text_lines.line_ids[file_id] = self.oie_lines.line_ids[file_id] = entries[0::3]
+      self.text_lines.offsets[file_id], self.oie_lines.offsets[file_id] = entries[1::3], entries[2::3]
+      with open(text_fname, 'r') as text_f, open(oie_fname, 'r') as oie_f:
+        for i in tqdm.tqdm(range(0, len(entries), 3), desc=f'Indexing {text_fname}'):
+          line_id, text_off, oie_off = entries[i:i+3]
+          text_f.seek(text_off)
+          oie_f.seek(oie_off)
+          # Only the parts that the regexes run on are indexed, i.e. not the paper ids
+          self.text_index.add(text_f.readline().split('\t', 1)[-1])
+          self.oie_index.add(oie_span_comp.sub('', oie_f.readline()).split('\t', 1)[-1])
+          self.file_ids.append(file_id)
+          self.line_ids.append(line_id)
+
+  def candidates(self, extractor: TemplateExtractor, text: str, oie: str) -> List[int]:
+    docs = set()
+    for regexes, compiled, index in [(text, extractor.text_regexes[0], self.text_index),
+                                     (oie, extractor.oie_regexes[0], self.oie_index)]:
+      if compiled is None:
+        continue
+      matching = index.candidates(get_regexes(regexes))
+      if matching is None:
+        return list(range(len(self.line_ids)))
+      docs |= matching
+    return sorted(docs)
+
+  def query(self, text: str = '', oie: str = '', type: str = '', max_keys: int = 100, max_per_key: int = 10) -> Dict:
+    """Run a template, given as its text regexes, OIE regexes and regex type, and group its answers by key.
+
+    Raises a re.error if a regex is invalid.
+    """
+    start = time.time()
+    store = ResultStore()
+    try:
+      extractor = TemplateExtractor([['', '', 'query', oie, text, '', type]], store)
+      docs = self.candidates(extractor, text, oie)
+      # Documents are in file and line order, so the answers are ordered like in the reports
+      for doc in docs:
+        file_id, line_id = self.file_ids[doc], self.line_ids[doc]
+        extractor.process_line(file_id, line_id, self.text_lines.line(file_id, line_id), self.oie_lines.line(file_id, line_id))
+      result = {'lines': len(self.line_ids), 'candidates': len(docs)}
+      for kind, name in [(TEXT, 'text'), (OIE, 'oie')]:
+        answers = []
+        for key_id, key, count in list(itertools.islice(store.iter_keys(0, kind), max_keys)):
+          answers.append({'answer': key, 'count': count,
+                          'sentences': [self.sentence(fid, lid) for fid, lid in store.refs(0, kind, key_id, max_per_key)]})
+        result[name] = {'keys': store.count_keys(0, kind), 'answers': answers}
+    finally:
+      store.close()
+    result['seconds'] = time.time() - start
+    return result
+
+  def sentence(self, file_id: int, line_id: int) -> Dict:
+    paper, text = self.text_lines.line(file_id, line_id).rstrip('\n').split('\t', 1)
+    sha = paper.split('/')[-1][:-5]
+    return {'sentence': text, 'paper': sha, 'metadata': self.metadata.get(sha)}
+
+
+def make_handler(index: QueryIndex, max_keys: int, max_per_key: int):
+  class QueryHandler(BaseHTTPRequestHandler):
+    """GET /query?text=...&oie=...&type=... or POST /query with the same fields in a JSON object."""
+
+    def do_GET(self):
+      url = urlparse(self.path)
+      if url.path != '/query':
+        self.send_error(404)
+        return
+      self.respond({k: v[-1] for k, v in parse_qs(url.query).items()})
+
+    def do_POST(self):
+      if urlparse(self.path).path != '/query':
+        self.send_error(404)
+        return
+      try:
+        params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+      except ValueError:
+        self.send_error(400, 'the body must be a JSON object')
+        return
+      self.respond(params)
+
+    def respond(self, params: Dict):
+      try:
+        result = index.query(params.get('text', ''), params.get('oie', ''), params.get('type', ''),
+                             int(params.get('max_keys', max_keys)), int(params.get('max_per_key', max_per_key)))
+      except (re.error, ValueError) as e:
+        self.send_error(400, str(e))
+        return
+      body = json.dumps(result).encode('utf-8')
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+  return QueryHandler
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Serve ad-hoc template queries over the text and OIE files')
+  parser.add_argument('--text_files', type=str, nargs='+', required=True, help='Text files')
+  parser.add_argument('--oie_files', type=str, nargs='+', required=True, help='OpenIE extractions')
+  parser.add_argument('--raw_data_dir', type=str, default=None, help='The directory with the metadata.csv of the release, to return paper metadata')
+  parser.add_argument('--metadata_index', type=str, default=None, help='The metadata index to use, built from metadata.csv if needed (default: metadata.db in raw_data_dir)')
+  parser.add_argument('--host', type=str, default='localhost', help='The address to serve on')
+  parser.add_argument('--port', type=int, default=8000, help='The port to serve on')
+  parser.add_argument('--max_keys', type=int, default=100, help='Number of answers returned by default')
+  parser.add_argument('--max_per_key', type=int, default=10, help='Number of sentences returned for each answer by default')
+  parser.add_argument('--text', type=str, default=None, help='Instead of serving, run one template with these text regexes (one per line) and print its answers')
+  parser.add_argument('--oie', type=str, default='', help='The OIE regexes of the template given with --text')
+  parser.add_argument('--type', type=str, default='', help='The regex type of the template given with --text (yonly to only return [Y])')
+  args = parser.parse_args()
+  if len(args.oie_files) != len(args.text_files):
+    raise ValueError('Lengths of the args.oie_files and args.text_files arguments must be the same')
+
+  metadata = None
+  if args.raw_data_dir:
+    metadata = open_metadata_index(f'{args.raw_data_dir}/metadata.csv', args.metadata_index or f'{args.raw_data_dir}/metadata.db')
+  start = time.time()
+  index = QueryIndex(args.text_files, args.oie_files, metadata)
+  print(f'Indexed {len(index.line_ids)} lines in {time.time() - start:.1f}s', file=sys.stderr)
+
+  if args.text is not None or args.oie:
+    print(json.dumps(index.query(args.text or '', args.oie, args.type, args.max_keys, args.max_per_key), indent=1))
+  else:
+    print(f'Serving queries on http://{args.host}:{args.port}/query', file=sys.stderr)
+    HTTPServer((args.host, args.port), make_handler(index, args.max_keys, args.max_per_key)).serve_forever()
@@ -0,0 +1,48 @@
+import hashlib
+import json
+import os
+import pickle
+from typing import List, Optional, Tuple
+
+
+def file_fingerprint(fname: str) -> Tuple[str, int, int]:
+  st = os.stat(fname)
+  return (os.path.abspath(fname), st.st_size, st.st_mtime_ns)
+
+
+class ResultCache:
+  """An on-disk cache of the matches of each template, so only new or changed templates scan the corpus.
+
+  An entry is keyed by a hash of the template's compiled text and OIE regexes and the fingerprints
+  (path, size and modification time) of the input files, so editing a template or touching an input
+  file invalidates it.
+  """
+
+  def __init__(self, cache_dir: str, text_files: List[str], oie_files: List[str]):
+    self.cache_dir = cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    self.files = [[file_fingerprint(t), file_fingerprint(o)] for t, o in zip(text_files, oie_files)]
+
+  def key(self, text_rex, oie_rex) -> str:
+    text_key = None if text_rex is None else [text_rex[0].pattern, text_rex[1], text_rex[2]]
+    oie_key = None if oie_rex is None else oie_rex.pattern
+    data = json.dumps([text_key, oie_key, self.files, 'hits+offsets'])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+  def _path(self, key: str) -> str:
+    return os.path.join(self.cache_dir, f'{key}.pkl')
+
+  def load(self, key: str) -> Optional[List[Tuple]]:
+    """The matches of a template as exported by `ResultStore.export`, or None if they are not cached."""
+    try:
+      with open(self._path(key), 'rb') as f:
+        return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+      return None
+
+  def save(self, key: str, hits: List[Tuple]):
+    # Write to a temporary file first so an interrupted run never leaves a truncated entry
+    tmp_path = self._path(key) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      pickle.dump(hits, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, self._path(key))
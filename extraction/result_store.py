@@ -0,0 +1,211 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Optional, Tuple
+from shards import line_offsets
+
+# The kinds of results of a template
+TEXT, OIE = 0, 1
+
+
+def text_hash(text: str) -> int:
+  return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+class ResultBuffer:
+  """Collects matches in memory as (template, kind, key, text hash, file id, line id, text offset), e.g. in a worker.
+
+  The text offset is the byte offset of the line in its text file, or -1 if it is not known.
+  """
+
+  def __init__(self):
+    self.hits = []
+
+  def add(self, template: int, kind: int, key: str, text: str, file_id: int, line_id: int, text_off: int = -1):
+    self.hits.append((template, kind, key, text_hash(text), file_id, line_id, text_off))
+
+  def add_hits(self, hits: Iterable[Tuple]):
+    self.hits.extend(hits)
+
+  def take(self) -> List[Tuple]:
+    hits, self.hits = self.hits, []
+    return hits
+
+
+class ResultStore:
+  """The matches of all templates, in an sqlite file so memory use does not grow with the corpus.
+
+  Like the dictionaries they replace, a sentence (identified by a hash of its text) is kept once per
+  key of a template, at the position it was first seen and with the reference (file id, line id) of
+  the last paper it was seen in. Sentences are only read back by reference when rendering. Keys are
+  interned in the file too, with the `key_cache` most recent ones cached in memory, and matches are
+  buffered in memory until `budget` of them are waiting to be written.
+  """
+
+  def __init__(self, path: Optional[str] = None, budget: int = 1000000, key_cache: int = 100000):
+    self.tmp = path is None
+    if path is None:
+      fd, path = tempfile.mkstemp(suffix='.db')
+      os.close(fd)
+    if os.path.exists(path):
+      os.remove(path)
+    self.path = path
+    self.db = sqlite3.connect(path)
+    self.db.executescript('''
+      PRAGMA journal_mode = OFF;
+      PRAGMA synchronous = OFF;
+      CREATE TABLE keys (key_id INTEGER PRIMARY KEY, key TEXT UNIQUE);
+      CREATE TABLE hits (template INTEGER, kind INTEGER, key_id INTEGER, text_hash INTEGER, file_id INTEGER,
+                         line_id INTEGER, text_off INTEGER, UNIQUE (template, kind, key_id, text_hash));''')
+    self.budget = budget
+    self.pending = []
+    # Cached per store, so that closed stores are not kept alive by the cache
+    self.key_id = lru_cache(maxsize=key_cache)(self._key_id)
+
+  def _key_id(self, key: str) -> int:
+    row = self.db.execute('SELECT key_id FROM keys WHERE key = ?', (key,)).fetchone()
+    if row is not None:
+      return row[0]
+    return self.db.execute('INSERT INTO keys (key) VALUES (?)', (key,)).lastrowid
+
+  def add(self, template: int, kind: int, key: str, text: str, file_id: int, line_id: int, text_off: int = -1):
+    self.pending.append((template, kind, self.key_id(key), text_hash(text), file_id, line_id, text_off))
+    if len(self.pending) >= self.budget:
+      self.flush()
+
+  def add_hits(self, hits: Iterable[Tuple]):
+    """Add matches collected by a `ResultBuffer` or exported by `export`."""
+    for template, kind, key, th, file_id, line_id, text_off in hits:
+      self.pending.append((template, kind, self.key_id(key), th, file_id, line_id, text_off))
+      if len(self.pending) >= self.budget:
+        self.flush()
+
+  def flush(self):
+    self.db.executemany('INSERT INTO hits VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (template, kind, key_id, text_hash) '
+                        'DO UPDATE SET file_id = excluded.file_id, line_id = excluded.line_id, text_off = excluded.text_off',
+                        self.pending)
+    self.db.commit()
+    self.pending = []
+
+  def count_keys(self, template: int, kind: int) -> int:
+    self.flush()
+    return self.db.execute('SELECT COUNT(DISTINCT key_id) FROM hits WHERE template = ? AND kind = ?',
+                           (template, kind)).fetchone()[0]
+
+  def iter_keys(self, template: int, kind: int) -> Iterator[Tuple[int, str, int]]:
+    """Yield (key id, key, number of sentences) by decreasing number of sentences, then in the order first seen."""
+    self.flush()
+    yield from self.db.execute(
+      'SELECT h.key_id, k.key, h.n FROM (SELECT key_id, COUNT(*) AS n, MIN(rowid) AS first FROM hits '
+      'WHERE template = ? AND kind = ? GROUP BY key_id) h JOIN keys k ON h.key_id = k.key_id ORDER BY h.n DESC, h.first',
+      (template, kind))
+
+  def refs(self, template: int, kind: int, key_id: int, limit: int) -> List[Tuple[int, int]]:
+    """The (file id, line id) of the first `limit` sentences of a key."""
+    return self.db.execute('SELECT file_id, line_id FROM hits WHERE template = ? AND kind = ? AND key_id = ? '
+                           'ORDER BY rowid LIMIT ?', (template, kind, key_id, limit)).fetchall()
+
+  def all_refs(self) -> Iterator[Tuple[int, int, int]]:
+    """The (file id, line id, text offset) of every line a result refers to, with an offset of -1 if it is not known."""
+    self.flush()
+    yield from self.db.execute('SELECT file_id, line_id, MAX(text_off) FROM hits GROUP BY file_id, line_id ORDER BY file_id, line_id')
+
+  def export(self, template: int) -> List[Tuple]:
+    """The matches of a template in the format of `add_hits`, e.g. to cache them."""
+    self.flush()
+    return self.db.execute('SELECT h.template, h.kind, k.key, h.text_hash, h.file_id, h.line_id, h.text_off FROM hits h '
+                           'JOIN keys k ON h.key_id = k.key_id WHERE h.template = ? ORDER BY h.rowid',
+                           (template,)).fetchall()
+
+  def close(self):
+    self.db.close()
+    if self.tmp:
+      os.remove(self.path)
+
+
+class LineReader:
+  """Reads lines by (file id, line id), by seeking to offsets that were collected beforehand."""
+
+  def __init__(self, fnames: List[str]):
+    self.fnames = fnames
+    self.line_ids = [array('q') for _ in fnames]
+    self.offsets = [array('q') for _ in fnames]
+    self.files = {}
+
+  def offset(self, file_id: int, line_id: int) -> int:
+    ids = self.line_ids[file_id]
+    i = bisect_left(ids, line_id)
+    if i == len(ids) or ids[i] != line_id:
+      raise KeyError((file_id, line_id))
+    return self.offsets[file_id][i]
+
+  def line(self, file_id: int, line_id: int) -> str:
+    f = self.files.get(file_id)
+    if f is None:
+      f = self.files[file_id] = open(self.fnames[file_id], 'r')
+    f.seek(self.offset(file_id, line_id))
+    return f.readline()
+
+  def close(self):
+    for f in self.files.values():
+      f.close()
+    self.files = {}
+
+
+def index_lines(fnames: List[str], refs: Iterable[Tuple[int, int, int]]) -> LineReader:
+  """A `LineReader` for the lines `refs` (sorted (file id, line id, text offset) as from `ResultStore.all_refs`).
+
+  Offsets that are not known (-1) are found in a single pass over the file, which is only needed
+  for the files that have any.
+  """
+  reader = LineReader(fnames)
+  by_file = defaultdict(lambda: (array('q'), array('q')))
+  for file_id, line_id, text_off in refs:
+    line_ids, offsets = by_file[file_id]
+    line_ids.append(line_id)
+    offsets.append(text_off)
+  for file_id, (line_ids, offsets) in by_file.items():
+    reader.line_ids[file_id] = line_ids
+    if min(offsets) < 0:
+      offsets = array('q', line_offsets(fnames[file_id], line_ids))
+    reader.offsets[file_id] = offsets
+  return reader
+
+
+class LineSpill(LineReader):
+  """Keeps the lines that may be rendered in a file of their own, when there are no text files to read them from."""
+
+  def __init__(self, path: str, n_files: int):
+    super().__init__([path] * n_files)
+    self.path = path
+    self.fout = open(path, 'wb')
+    self.size = 0
+    self.dirty = False
+
+  def add(self, file_id: int, line_id: int, line: str):
+    # Lines are added in order of line id within each file
+    data = line.encode('utf-8')
+    self.line_ids[file_id].append(line_id)
+    self.offsets[file_id].append(self.size)
+    self.fout.write(data)
+    self.size += len(data)
+    self.dirty = True
+
+  def line(self, file_id: int, line_id: int) -> str:
+    if self.dirty:
+      self.fout.flush()
+      self.dirty = False
+    f = self.files.get(0)
+    if f is None:
+      f = self.files[0] = open(self.path, 'rb')
+    f.seek(self.offset(file_id, line_id))
+    return f.readline().decode('utf-8')
+
+  def close(self):
+    super().close()
+    self.fout.close()
@@ -0,0 +1,96 @@
+import os
+import re
+from typing import List, Tuple
+
+# Same line terminators as files opened in text mode with universal newlines
+newline_re = re.compile(rb'\r\n|\r|\n')
+chunk_size = 1 << 24
+
+
+def _read_chunk(f, size: int = chunk_size) -> bytes:
+  """Read a chunk, making sure a \\r\\n terminator is never split across chunks."""
+  data = f.read(size)
+  if data.endswith(b'\r'):
+    data += f.read(1)
+  return data
+
+
+def _count_lines(data: bytes) -> int:
+  return data.count(b'\n') + data.count(b'\r') - data.count(b'\r\n')
+
+
+def line_start(fname: str, pos: int) -> int:
+  """Return the byte offset of the first line that starts at or after `pos`."""
+  if pos <= 0:
+    return 0
+  with open(fname, 'rb') as f:
+    f.seek(pos - 1)
+    base = pos - 1
+    while True:
+      data = _read_chunk(f)
+      if not data:
+        return base
+      for m in newline_re.finditer(data):
+        if base + m.end() >= pos:
+          return base + m.end()
+      base += len(data)
+
+
+def count_lines(fname: str, start: int, end: int) -> int:
+  """Count the lines in the byte range [start, end) of a file, which must start on a line boundary."""
+  n = 0
+  with open(fname, 'rb') as f:
+    f.seek(start)
+    pos = start
+    while pos < end:
+      data = _read_chunk(f, min(chunk_size, end - pos))
+      if not data:
+        break
+      n += _count_lines(data)
+      pos += len(data)
+  return n
+
+
+def line_offsets(fname: str, line_ids: List[int]) -> List[int]:
+  """Return the byte offset where each of the (sorted) `line_ids` starts."""
+  offsets = []
+  i, line, base = 0, 0, 0
+  with open(fname, 'rb') as f:
+    while i < len(line_ids) and line_ids[i] <= line:
+      offsets.append(0); i += 1
+    while i < len(line_ids):
+      data = _read_chunk(f)
+      if not data:
+        break
+      n = _count_lines(data)
+      if line + n >= line_ids[i]:
+        for m in newline_re.finditer(data):
+          line += 1
+          while i < len(line_ids) and line_ids[i] == line:
+            offsets.append(base + m.end()); i += 1
+      else:
+        line += n
+      base += len(data)
+  # Lines past the end of the file start (and are empty) at the end of the file
+  offsets.extend([base] * (len(line_ids) - i))
+  return offsets
+
+
+def shard_file_pair(text_fname: str, oie_fname: str, n_shards: int) -> List[Tuple[int, int, int, int]]:
+  """Split aligned text/OIE files into byte ranges that start on line boundaries.
+
+  :return: a list of (first line id, number of lines, text byte offset, OIE byte offset) per shard.
+  """
+  size = os.path.getsize(text_fname)
+  starts = sorted(set(line_start(text_fname, size * k // n_shards) for k in range(n_shards)))
+  ends = starts[1:] + [size]
+  counts = [count_lines(text_fname, s, e) for s, e in zip(starts, ends)]
+  # A final line without a terminator still counts as a line
+  if size and counts and ends[-1] > starts[-1]:
+    with open(text_fname, 'rb') as f:
+      f.seek(size - 1)
+      if f.read(1) not in (b'\n', b'\r'):
+        counts[-1] += 1
+  line_ids = [sum(counts[:k]) for k in range(len(counts))]
+  oie_starts = line_offsets(oie_fname, line_ids)
+  return [(lid, cnt, ts, os_) for lid, cnt, ts, os_ in zip(line_ids, counts, starts, oie_starts) if cnt]
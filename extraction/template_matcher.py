@@ -0,0 +1,176 @@
+from typing import Dict, List, Optional, Set
+import ahocorasick
+
+placeholders = ('[X]', '[Y]', '[B]')
+quantifiers = '*+?{'
+octal_digits = '01234567'
+
+
+def _skip_group(regex: str, i: int, opening: str, closing: str) -> int:
+  """Return the index just after the group that starts at regex[i]."""
+  depth = 0
+  while i < len(regex):
+    c = regex[i]
+    if c == '\\':
+      i += 2
+      continue
+    if c == '[':
+      # Brackets inside a character class do not open or close groups
+      i = _skip_class(regex, i)
+      continue
+    if c == opening:
+      depth += 1
+    elif c == closing:
+      depth -= 1
+      if depth == 0 or opening == closing:
+        return i + 1
+    i += 1
+  return i
+
+
+def _skip_escape(regex: str, i: int) -> int:
+  """Return the index just after the escape that starts at regex[i], including its argument if it has one.
+
+  The argument of `\\x`, `\\u`, `\\U`, `\\N{...}`, octal escapes and backreferences is part of the escape,
+  not plain characters that follow it.
+  """
+  start, c = i, regex[i+1:i+2]
+  i += 2
+  if c in ('x', 'u', 'U'):
+    i += {'x': 2, 'u': 4, 'U': 8}[c]
+  elif c == 'N' and regex.startswith('{', i):
+    i = regex.find('}', i) + 1 or len(regex)
+  elif c == '0':
+    # \0 takes up to two more octal digits
+    while i < min(start + 4, len(regex)) and regex[i] in octal_digits:
+      i += 1
+  elif c.isdigit():
+    # Three octal digits are an octal escape, otherwise up to two digits are a backreference
+    if len(regex[i:i+2]) == 2 and all(d in octal_digits for d in c + regex[i:i+2]):
+      i += 2
+    elif regex[i:i+1].isdigit():
+      i += 1
+  return min(i, len(regex))
+
+
+def _skip_class(regex: str, i: int) -> int:
+  """Return the index just after the character class that starts at regex[i].
+
+  A `]` right after the opening `[` (or `[^`) is a member of the class rather than its end, and a
+  `[` inside the class is a plain character (unless it starts a placeholder).
+  """
+  i += 1
+  if regex.startswith('^', i):
+    i += 1
+  if regex.startswith(']', i):
+    i += 1
+  while i < len(regex):
+    # Placeholders are substituted inside classes too, and what they become has no `]`
+    if regex.startswith(placeholders, i):
+      i += 3
+      continue
+    c = regex[i]
+    if c == '\\':
+      i += 2
+      continue
+    if c == ']':
+      return i + 1
+    i += 1
+  return i
+
+
+def required_literals(regex: str) -> Optional[List[str]]:
+  """Find the literal substrings that every match of a template regex must contain.
+
+  The regex is a single line returned by `get_regexes`, i.e. before [X]/[Y]/[B] are substituted.
+  Anything that is not a plain character (placeholders, groups, classes, wildcards and optional
+  characters) ends the current literal. Returns None if the regex has a top-level alternation,
+  in which case no single literal is required.
+  """
+  literals, cur = [], ''
+  i = 0
+  while i < len(regex):
+    if regex.startswith(placeholders, i):
+      literals.append(cur); cur = ''
+      i += 3
+      continue
+    c = regex[i]
+    if c == '|':
+      return None
+    if c in quantifiers:
+      # The previous character was optional or repeated, so it cannot be relied on
+      if c == '+':
+        literals.append(cur)
+      else:
+        literals.append(cur[:-1])
+      cur = ''
+      i = _skip_group(regex, i, '{', '}') if c == '{' else i + 1
+      if i < len(regex) and regex[i] in '?+':
+        i += 1
+      continue
+    if c == '(':
+      literals.append(cur); cur = ''
+      i = _skip_group(regex, i, '(', ')')
+    elif c == '[':
+      literals.append(cur); cur = ''
+      i = _skip_class(regex, i)
+    elif c == '\\':
+      nxt = regex[i+1:i+2]
+      i = _skip_escape(regex, i)
+      if nxt.isalnum() or not nxt:
+        literals.append(cur); cur = ''
+      else:
+        # An escaped character is a plain character, which a quantifier makes optional like any other
+        cur += nxt
+        continue
+    elif c in '.^$':
+      literals.append(cur); cur = ''
+      i += 1
+    else:
+      cur += c
+      i += 1
+      continue
+    # A quantifier after a group, class or escape applies to the whole atom, which is already dropped
+    if i < len(regex) and regex[i] in quantifiers:
+      literals.append(cur); cur = ''
+      i = _skip_group(regex, i, '{', '}') if regex[i] == '{' else i + 1
+      if i < len(regex) and regex[i] in '?+':
+        i += 1
+  literals.append(cur)
+  return [x for x in literals if x]
+
+
+class TemplateMatcher:
+  """Pick the templates that can possibly match a line with a single multi-string search.
+
+  Each template is a list of alternative regexes. A regex is indexed under its longest required
+  literal, and a template is a candidate for a line if any of its regexes has its literal in the line.
+  Templates with a regex that has no required literal are always candidates.
+  """
+
+  def __init__(self, template_regexes: List[Optional[List[str]]]):
+    self.always: Set[int] = set()
+    self.literal_ids: Dict[str, Set[int]] = {}
+    for i, regexes in enumerate(template_regexes):
+      if not regexes:
+        continue
+      for regex in regexes:
+        literals = required_literals(regex)
+        if not literals:
+          self.always.add(i)
+        else:
+          self.literal_ids.setdefault(max(literals, key=len), set()).add(i)
+    if self.literal_ids:
+      self.automaton = ahocorasick.Automaton()
+      for literal, ids in self.literal_ids.items():
+        self.automaton.add_word(literal, ids)
+      self.automaton.make_automaton()
+    else:
+      self.automaton = None
+
+  def candidates(self, line: str) -> Set[int]:
+    ids = set(self.always)
+    if self.automaton is not None:
+      for _, literal_ids in self.automaton.iter(line):
+        ids |= literal_ids
+    return ids
@@ -0,0 +1,67 @@
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Optional, Set
+from template_matcher import required_literals
+
+
+def trigrams(text: str) -> Set[str]:
+  return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+def _contains(postings: array, doc_id: int) -> bool:
+  i = bisect_left(postings, doc_id)
+  return i < len(postings) and postings[i] == doc_id
+
+
+class TrigramIndex:
+  """Maps every trigram to the sorted ids of the documents it occurs in, like a code search engine.
+
+  A template regex can only match a document that contains every trigram of its required literals
+  (see `required_literals`), so `candidates` narrows a search down to the few documents the real
+  regex has to verify. Regexes whose literals are all shorter than a trigram match any document.
+  """
+
+  def __init__(self):
+    self.n_docs = 0
+    self.postings: Dict[str, array] = {}
+
+  def add(self, text: str) -> int:
+    """Index the next document and return its id."""
+    doc_id = self.n_docs
+    for t in trigrams(text):
+      postings = self.postings.get(t)
+      if postings is None:
+        postings = self.postings[t] = array('I')
+      postings.append(doc_id)
+    self.n_docs += 1
+    return doc_id
+
+  def lookup(self, literals: List[str]) -> Optional[Set[int]]:
+    """The documents that contain all the literals, or None if they have no trigram at all."""
+    grams = set()
+    for literal in literals:
+      grams |= trigrams(literal)
+    if not grams:
+      return None
+    lists = sorted((self.postings.get(t, array('I')) for t in grams), key=len)
+    docs = set(lists[0])
+    for postings in lists[1:]:
+      if not docs:
+        break
+      # Once few documents are left, look them up in a long list instead of scanning it
+      if len(docs) * 16 < len(postings):
+        docs = {d for d in docs if _contains(postings, d)}
+      else:
+        docs.intersection_update(postings)
+    return docs
+
+  def candidates(self, regexes: List[str]) -> Optional[Set[int]]:
+    """The documents that may match any of the regexes (lines from `get_regexes`), or None if any document may."""
+    docs = set()
+    for regex in regexes:
+      literals = required_literals(regex)
+      matching = self.lookup(literals) if literals else None
+      if matching is None:
+        return None
+      docs |= matching
+    return docs
@@ -1,28 +1,21 @@
 #!/usr/bin/env bash
 
-inp_dir=new-text-only
-threads=20
+# The directory of the .sent files, e.g. dedup-text-only after dedup_sents.py
+inp_dir=${1:-new-text-only}
+servers=4
+threads=5
+# Optionally, a file caching the triples of sentences seen in earlier runs
+cache=
 
 set -e
 
+# Run oie over all files with a pool of long-lived CoreNLP servers that take chunks of sentences as
+# they become free, writing ${f}.oie for each ${f}.sent in the original order (rerun to resume)
+python oie/oie_scheduler.py --inp ${inp_dir}/*.sent --servers ${servers} --threads ${threads} --concurrency ${threads} \
+    --resume ${cache:+--cache ${cache}}
+
+# make sure every file finished and is aligned with its input
 for f in ${inp_dir}/*.sent
 do
-    # split the file into n pieces
-    sp_dir=${f}.sp
-    #rm -rf ${f}.sp
-    mkdir -p ${sp_dir}
-    split -l$((`wc -l < ${f}`/${threads})) ${f} ${sp_dir}/sp -da 5
-
-    # run oie concurrently
-    for spf in ${sp_dir}/*
-    do
-        fout=${spf}.oie
-        flog=${spf}.log
-        echo "oie/stanford_oie.py --inp $spf --out $fout"
-        python oie/stanford_oie.py --inp $spf --out $fout &> $flog &
-    done
-    wait
-
-    # merge files
-    ls -v ${sp_dir}/*.oie | xargs cat > ${f}.oie
+    python oie/stanford_oie.py --task check --inp ${f} --out ${f}.oie
 done
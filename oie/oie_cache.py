@@ -0,0 +1,73 @@
+import hashlib
+import sqlite3
+import threading
+from typing import List, Optional
+from oie_format import Triple, str_to_triples, triples_to_str
+
+
+class OIECache:
+    """A persistent cache of OpenIE triples keyed by a hash of the sentence text.
+
+    The text is hashed exactly as annotated (input lines are already stripped) since the span offsets of
+    the triples refer to it. The namespace (e.g. the CoreNLP version) and
+    variant (e.g. annotation options) separate triples of the same text that could differ.
+    It can be shared by threads, e.g. the workers of several servers in oie_scheduler.py.
+    """
+
+    def __init__(self, path: str, namespace: str = '', commit_every: int = 1000):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute('CREATE TABLE IF NOT EXISTS triples (key BLOB PRIMARY KEY, triples TEXT)')
+        self.namespace = namespace
+        self.commit_every = commit_every
+        # Triples put since the last commit, looked up before the database so recent repeats also hit
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text: str, variant: str = '') -> bytes:
+        return hashlib.sha1('{}\t{}\t{}'.format(self.namespace, variant, text).encode('utf-8')).digest()
+
+    def get(self, text: str, variant: str = '') -> Optional[List[Triple]]:
+        key = self.key(text, variant)
+        with self.lock:
+            triples = self.pending.get(key)
+            if triples is None:
+                row = self.db.execute('SELECT triples FROM triples WHERE key = ?', (key,)).fetchone()
+                triples = row[0] if row is not None else None
+            if triples is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return str_to_triples(triples)
+
+    def put(self, text: str, triples: List[Triple], variant: str = ''):
+        key, triples = self.key(text, variant), triples_to_str(triples)
+        with self.lock:
+            self.pending[key] = triples
+            if len(self.pending) >= self.commit_every:
+                self._commit()
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        self.db.executemany('INSERT OR REPLACE INTO triples VALUES (?, ?)', self.pending.items())
+        self.db.commit()
+        self.pending = {}
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        return 'oie cache: {} hits, {} misses ({:.1f}% hit rate)'.format(
+            self.hits, self.misses, 100 * self.hits / total if total else 0)
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
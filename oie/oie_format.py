@@ -0,0 +1,207 @@
+import argparse
+import mmap
+import os
+from array import array
+from collections import namedtuple
+from typing import Dict, Iterable, Iterator, List, Tuple
+import numpy as np
+from tqdm import tqdm
+
+
+Span = namedtuple('Span', ['text', 'start', 'end'])
+Triple = namedtuple('Triple', ['subject', 'relation', 'object'])
+
+
+def get_triple_len(triple: Triple):
+    l = triple.subject.end - triple.subject.start + \
+        triple.relation.end - triple.relation.start + \
+        triple.object.end - triple.object.start
+    return l
+
+
+def span_to_str(span: Span):
+    return '{}#{},{}'.format(span.text, span.start, span.end)
+
+
+def str_to_span(string: str) -> Span:
+    text, pos = string.rsplit('#', 1)
+    s, e = list(map(int, pos.split(',')))
+    return Span(text, s, e)
+
+
+def triples_to_str(triples: List[Triple]):
+    return '\t'.join(map(lambda t: '|||'.join(
+        [span_to_str(t.subject), span_to_str(t.relation), span_to_str(t.object)]), triples))
+
+
+def str_to_triples(string: str) -> List[Triple]:
+    if len(string) == 0:
+        return []
+    return [Triple(*[str_to_span(e) for e in t.split('|||')]) for t in string.split('\t')]
+
+
+class OIEStoreWriter:
+    """Write OpenIE triples to a binary store, a directory with the following files:
+
+    - `strings.bin`/`string_offsets.npy`: a table of the deduplicated sentence ids and span texts
+    - `sent_ids.npy`: the string id of the id of each sentence
+    - `sent_index.npy`: sentence i has the triples sent_index[i]:sent_index[i+1]
+    - `spans.npy`: one row of (text string id, start, end) x (subject, relation, object) per triple
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.strings_f = open(os.path.join(path, 'strings.bin'), 'wb')
+        self.string_ids: Dict[str, int] = {}
+        self.string_offsets = array('q', [0])
+        self.sent_ids = array('i')
+        self.sent_index = array('q', [0])
+        self.spans = array('i')
+
+    def string_id(self, string: str) -> int:
+        sid = self.string_ids.get(string)
+        if sid is None:
+            sid = self.string_ids[string] = len(self.string_ids)
+            data = string.encode('utf-8')
+            self.strings_f.write(data)
+            self.string_offsets.append(self.string_offsets[-1] + len(data))
+        return sid
+
+    def add(self, id: str, triples: List[Triple]):
+        self.sent_ids.append(self.string_id(id))
+        for t in triples:
+            for span in t:
+                self.spans.extend((self.string_id(span.text), span.start, span.end))
+        self.sent_index.append(self.sent_index[-1] + len(triples))
+
+    def close(self):
+        self.strings_f.close()
+        for name, arr, dtype in [('string_offsets', self.string_offsets, np.int64),
+                                 ('sent_ids', self.sent_ids, np.int32),
+                                 ('sent_index', self.sent_index, np.int64),
+                                 ('spans', self.spans, np.int32)]:
+            np.save(os.path.join(self.path, name + '.npy'), np.frombuffer(arr, dtype=dtype).reshape((-1, 9) if name == 'spans' else -1))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class OIEStoreReader:
+    """Memory-mapped random access to a store written by `OIEStoreWriter`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        self.string_offsets = load('string_offsets')
+        self.sent_ids = load('sent_ids')
+        self.sent_index = load('sent_index')
+        self.spans = load('spans')
+        with open(os.path.join(path, 'strings.bin'), 'rb') as f:
+            # mmap cannot map an empty file
+            self.strings = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.string_offsets[-1] else b''
+
+    def __len__(self):
+        return len(self.sent_ids)
+
+    def string(self, sid: int) -> str:
+        return self.strings[self.string_offsets[sid]:self.string_offsets[sid + 1]].decode('utf-8')
+
+    def id(self, i: int) -> str:
+        return self.string(self.sent_ids[i])
+
+    def span_array(self, i: int) -> np.ndarray:
+        """The (n_triples, 9) array of string ids and offsets of sentence i, without decoding any text."""
+        return self.spans[self.sent_index[i]:self.sent_index[i + 1]]
+
+    def triples(self, i: int) -> List[Triple]:
+        return [Triple(*[Span(self.string(row[j]), int(row[j + 1]), int(row[j + 2])) for j in (0, 3, 6)])
+                for row in self.span_array(i)]
+
+    def __iter__(self) -> Iterator[Tuple[str, List[Triple]]]:
+        for i in range(len(self)):
+            yield self.id(i), self.triples(i)
+
+
+def read_oie(path: str) -> Iterable[Tuple[str, List[Triple]]]:
+    """Iterate over (id, triples) of either a text `.oie` file or a binary store."""
+    if os.path.isdir(path):
+        yield from OIEStoreReader(path)
+    else:
+        with open(path, 'r') as fin:
+            for l in fin:
+                id, text = l.rstrip('\n').split('\t', 1)
+                yield id, str_to_triples(text)
+
+
+def split_oie(path: str, chunk_bytes: int) -> List[Tuple[int, int]]:
+    """Split a text `.oie` file into line-aligned byte ranges, or a store into sentence ranges, of about chunk_bytes each."""
+    chunk_bytes = max(chunk_bytes, 1)
+    if os.path.isdir(path):
+        sent_index = OIEStoreReader(path).sent_index
+        n = len(sent_index) - 1
+        n_chunks = max(1, -(-int(sent_index[-1]) * 36 // chunk_bytes))
+        bounds = sorted(set(n * i // n_chunks for i in range(n_chunks + 1)))
+    else:
+        size = os.path.getsize(path)
+        bounds = [0]
+        with open(path, 'rb') as fin:
+            while bounds[-1] + chunk_bytes < size:
+                fin.seek(bounds[-1] + chunk_bytes)
+                fin.readline()
+                bounds.append(fin.tell())
+        bounds.append(size)
+    return [(s, e) for s, e in zip(bounds, bounds[1:]) if e > s]
+
+
+def read_oie_lines(path: str, start: int, end: int) -> Iterator[Tuple[str, str]]:
+    """Iterate over (id, triples string) of the lines of a text `.oie` file that start in the byte range [start, end)."""
+    with open(path, 'rb') as fin:
+        if start > 0:
+            fin.seek(start - 1)
+            fin.readline()
+        while fin.tell() < end:
+            l = fin.readline()
+            if not l:
+                break
+            id, text = l.decode('utf-8').rstrip('\n').split('\t', 1)
+            yield id, text
+
+
+def span_text(span: str) -> str:
+    return span[:span.rindex('#')]
+
+
+def span_len(span: str) -> int:
+    """The length of a span string like `str_to_span` would parse it, without building the `Span`."""
+    p = span.rindex('#')
+    c = span.index(',', p)
+    return int(span[c + 1:]) - int(span[p + 1:c])
+
+
+def text_to_store(inp: str, out: str):
+    with OIEStoreWriter(out) as writer:
+        for id, triples in tqdm(read_oie(inp)):
+            writer.add(id, triples)
+
+
+def store_to_text(inp: str, out: str):
+    with open(out, 'w') as fout:
+        for id, triples in tqdm(read_oie(inp)):
+            fout.write('{}\t{}\n'.format(id, triples_to_str(triples)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert open ie extractions between the text and binary formats')
+    parser.add_argument('--task', type=str, choices=['to_store', 'to_text'], required=True)
+    parser.add_argument('--inp', type=str, help='input file')
+    parser.add_argument('--out', type=str, help='output file')
+    args = parser.parse_args()
+
+    if args.task == 'to_store':
+        text_to_store(args.inp, args.out)
+    elif args.task == 'to_text':
+        store_to_text(args.inp, args.out)
@@ -0,0 +1,200 @@
+import argparse
+import itertools
+import os
+import queue
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Tuple
+from tqdm import tqdm
+from oie_cache import OIECache
+from stanford_oie import CORE_NLP_VERSION, Checkpoint, StanfordOpenIE
+from oie_format import triples_to_str
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import profiling
+
+
+def read_chunks(fin, chunk_chars: int, max_chunk_lines: int, start: int = 0) -> Iterator[List[Tuple[int, str, str]]]:
+    """Group consecutive lines into chunks of about chunk_chars characters, since parse cost grows with length.
+
+    Lines are numbered from start, e.g. when resuming after the first start lines of the file.
+    """
+    chunk, n_chars = [], 0
+    for lid, line in enumerate(fin, start):
+        id, text = line.strip().split('\t')
+        chunk.append((lid, id, text))
+        n_chars += len(text)
+        if n_chars >= chunk_chars or len(chunk) >= max_chunk_lines:
+            yield chunk
+            chunk, n_chars = [], 0
+    if chunk:
+        yield chunk
+
+
+class ServerStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chunks = defaultdict(lambda: 0)
+        self.sents = defaultdict(lambda: 0)
+        self.chars = defaultdict(lambda: 0)
+        self.busy = defaultdict(lambda: 0.0)
+
+    def add(self, server: int, chunk: List[Tuple[int, str, str]], elapsed: float):
+        with self.lock:
+            self.chunks[server] += 1
+            self.sents[server] += len(chunk)
+            self.chars[server] += sum(len(text) for _, _, text in chunk)
+            self.busy[server] += elapsed
+
+    def report(self, wall: float, concurrency: int) -> str:
+        lines = ['server\tchunks\tsents\tsents/sec\tchars/sec\tbusy']
+        for server in sorted(self.sents):
+            lines.append('{}\t{}\t{}\t{:.1f}\t{:.1f}\t{:.0f}%'.format(
+                server, self.chunks[server], self.sents[server], self.sents[server] / wall,
+                self.chars[server] / wall, 100 * self.busy[server] / (wall * concurrency)))
+        total = sum(self.sents.values())
+        lines.append('total\t{}\t{}\t{:.1f}'.format(sum(self.chunks.values()), total, total / wall))
+        return '\n'.join(lines)
+
+
+def annotate_chunks(clients: List[StanfordOpenIE], chunks: Iterator[List[Tuple[Any, str, str]]], batch_size: int,
+                    concurrency: int, max_len: int, stats: ServerStats) -> Iterator[Tuple[List, List, List]]:
+    """Annotate chunks of (key, id, text) with a pool of servers and yield (chunk, results, skipped) in input order.
+
+    Chunks are handed out dynamically: every server runs `concurrency` worker threads that take the
+    next chunk from a shared queue as soon as they finish one, so no server waits on a straggler.
+    The chunks are read in a separate thread, which blocks once too many chunks are waiting to be
+    yielded, so a slow consumer also slows down whatever produces the chunks.
+    """
+    jobs = queue.Queue(maxsize=len(clients) * concurrency)
+    done = queue.Queue()
+    # Bounds the number of chunks read but not yet yielded, e.g. while waiting for a slow chunk
+    outstanding = threading.Semaphore(len(clients) * concurrency * 4)
+
+    def work(server: int, client: StanfordOpenIE):
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            chunk_id, chunk = job
+            skipped = []
+            start = time.time()
+            try:
+                results = list(client.annotate_batch(
+                    ((id, text) for _, id, text in chunk), batch_size=batch_size, concurrency=1,
+                    max_len=max_len, on_skip=lambda i, id, reason: skipped.append((chunk[i][0], id, reason))))
+            except Exception as e:
+                done.put((chunk_id, e, None))
+                continue
+            stats.add(server, chunk, time.time() - start)
+            done.put((chunk_id, results, skipped))
+
+    def produce():
+        n_chunks = 0
+        try:
+            for chunk in chunks:
+                outstanding.acquire()
+                pending_chunks[n_chunks] = chunk
+                jobs.put((n_chunks, chunk))
+                n_chunks += 1
+        except Exception as e:
+            done.put((None, e, None))
+            return
+        done.put((None, n_chunks, None))
+
+    workers = [threading.Thread(target=work, args=(server, client), daemon=True)
+               for server, client in enumerate(clients) for _ in range(concurrency)]
+    for w in workers:
+        w.start()
+    pending_chunks: Dict[int, List] = {}
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    pending: Dict[int, Tuple] = {}
+    next_chunk, n_chunks = 0, None
+    while n_chunks is None or next_chunk < n_chunks:
+        chunk_id, results, skipped = done.get()
+        if isinstance(results, Exception):
+            raise results
+        if chunk_id is None:
+            n_chunks = results
+            continue
+        pending[chunk_id] = (results, skipped)
+        # Yield finished chunks in their original order
+        while next_chunk in pending:
+            results, skipped = pending.pop(next_chunk)
+            yield pending_chunks.pop(next_chunk), results, skipped
+            outstanding.release()
+            next_chunk += 1
+    producer.join()
+    for _ in workers:
+        jobs.put(None)
+    for w in workers:
+        w.join()
+
+
+def annotate_file(clients: List[StanfordOpenIE], inp: str, out: str, args, stats: ServerStats):
+    """Annotate a .sent file with a pool of servers and write the triples to one .oie file in input order.
+
+    Like `stanford_oie.py --task run`, the progress is checkpointed to <out>.ckpt (see --resume), and the
+    file is only marked as done once its output has as many lines as its input.
+    """
+    ckpt = Checkpoint(inp, out, args.resume)
+    if ckpt.done:
+        print('{} is already complete'.format(out))
+        return
+    start_line = ckpt.lines
+    with open(inp, 'r') as fin, ckpt as (fout, skip_f), tqdm(desc=inp, initial=start_line) as pbar:
+        chunks = read_chunks(itertools.islice(fin, start_line, None), args.chunk_chars, args.batch_size * 8, start_line)
+        lines = start_line
+        for _, results, skipped in annotate_chunks(clients, chunks, args.batch_size, args.concurrency, args.max_len, stats):
+            for id, triples in results:
+                fout.write('{}\t{}\n'.format(id, triples_to_str(triples)))
+            for lid, id, reason in skipped:
+                skip_f.write('{}\t{}\t{}\n'.format(lid, id, reason))
+            lines += len(results)
+            pbar.update(len(results))
+            if lines - ckpt.lines >= args.checkpoint_every:
+                ckpt.commit(lines)
+        ckpt.commit(lines)
+    ckpt.finish(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run open ie on text files with a pool of CoreNLP servers')
+    parser.add_argument('--inp', type=str, nargs='+', help='input .sent files')
+    parser.add_argument('--out_suffix', type=str, help='the output of each input file is written to <inp><out_suffix>',
+                        default='.oie')
+    parser.add_argument('--servers', type=int, help='number of CoreNLP servers to start', default=4)
+    parser.add_argument('--port', type=int, help='port of the first server (the others use the following ports)',
+                        default=9000)
+    parser.add_argument('--threads', type=int, help='number of threads for each CoreNLP server', default=5)
+    parser.add_argument('--memory', type=str, help='memory of each CoreNLP server', default='8G')
+    parser.add_argument('--concurrency', type=int, help='number of requests in flight to each server', default=5)
+    parser.add_argument('--batch_size', type=int, help='number of sentences packed into one CoreNLP request', default=32)
+    parser.add_argument('--chunk_chars', type=int, help='number of characters handed out to a server at once',
+                        default=20000)
+    parser.add_argument('--max_len', type=int, help='sentences this long or longer are skipped', default=15000)
+    parser.add_argument('--cache', type=str, help='sqlite file caching the triples of sentences seen before')
+    parser.add_argument('--resume', action='store_true', help='continue interrupted files from their last checkpoint')
+    parser.add_argument('--checkpoint_every', type=int, help='number of output lines between checkpoints', default=1000)
+    parser.add_argument('--profile', type=str, help='write a profile (request latencies, skipped sentences) to this .json or .csv file')
+    parser.add_argument('--profile_every', type=float, help='also write the profile every this many seconds', default=0)
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile, args.profile_every)
+
+    # A single cache shared by the worker threads of all servers
+    cache = OIECache(args.cache, namespace=CORE_NLP_VERSION) if args.cache else None
+    clients = [StanfordOpenIE(threads=args.threads, close_after_finish=True, memory=args.memory, cache=cache,
+                              endpoint='http://localhost:{}'.format(args.port + i)) for i in range(args.servers)]
+    for client in clients:
+        client.open_session(args.concurrency)
+    stats = ServerStats()
+    start = time.time()
+    for inp in args.inp:
+        annotate_file(clients, inp, inp + args.out_suffix, args, stats)
+    print(stats.report(time.time() - start, args.concurrency))
+    if cache is not None:
+        print(cache.stats())
+        cache.close()
@@ -1,54 +1,43 @@
 import argparse
-from typing import Dict, List, Set
+import bisect
+import itertools
+import json
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple, Union
 import os
-from collections import namedtuple, defaultdict
+import sys
+from collections import Counter, deque
+from functools import partial
 from tqdm import tqdm
 import spacy
 import string
+import time
 from pathlib import Path
 from zipfile import ZipFile
 import numpy as np
+import requests
 import wget
+from oie_cache import OIECache
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import profiling
+from profiling import profiler
+from oie_format import Span, Triple, triples_to_str, OIEStoreReader, OIEStoreWriter, split_oie, read_oie_lines, \
+    span_text, span_len
 os.environ['STANFORD_HOME'] = '/lfs/local/0/xren7/zhengbaj/stanford_home'
+CORE_NLP_VERSION = '2018-10-05'
 
 
-Span = namedtuple('Span', ['text', 'start', 'end'])
-Triple = namedtuple('Triple', ['subject', 'relation', 'object'])
 punct = set(list(string.punctuation))
 nlp = spacy.load('en_core_web_sm')
 stopwords = nlp.Defaults.stop_words
 
 
-def get_triple_len(triple: Triple):
-    l = triple.subject.end - triple.subject.start + \
-        triple.relation.end - triple.relation.start + \
-        triple.object.end - triple.object.start
-    return l
-
-
-def span_to_str(span: Span):
-    return '{}#{},{}'.format(span.text, span.start, span.end)
-
-
-def str_to_span(string: str) -> Span:
-    text, pos = string.rsplit('#', 1)
-    s, e = list(map(int, pos.split(',')))
-    return Span(text, s, e)
-
-
-def triples_to_str(triples: List[Triple]):
-    return '\t'.join(map(lambda t: '|||'.join(
-        [span_to_str(t.subject), span_to_str(t.relation), span_to_str(t.object)]), triples))
-
-
-def str_to_triples(string: str) -> List[Triple]:
-    if len(string) == 0:
-        return []
-    return [Triple(*[str_to_span(e) for e in t.split('|||')]) for t in string.split('\t')]
-
-
 class StanfordOpenIE:
-    def __init__(self, core_nlp_version: str = '2018-10-05', threads: int = 5, close_after_finish: bool = True):
+    def __init__(self, core_nlp_version: str = CORE_NLP_VERSION, threads: int = 5, close_after_finish: bool = True,
+                 request_timeout: float = 600, cache: OIECache = None,
+                 endpoint: str = 'http://localhost:9000', memory: str = '8G'):
         self.remote_url = 'http://nlp.stanford.edu/software/stanford-corenlp-full-{}.zip'.format(core_nlp_version)
         self.install_dir = Path(os.environ['STANFORD_HOME']).expanduser()
         self.install_dir.mkdir(exist_ok=True)
@@ -63,28 +52,48 @@ class StanfordOpenIE:
         os.environ['CORENLP_HOME'] = str(self.install_dir / 'stanford-corenlp-full-2018-10-05')
         from stanfordnlp.server import CoreNLPClient
         self.close_after_finish = close_after_finish
-        self.client = CoreNLPClient(annotators=['openie'], memory='8G', threads=threads)
-
-    def get_openie_with_boundary(self, annotation: Dict, remove_dup: bool = False) -> List[Triple]:
-        triples: List[Triple] = []
-        dup: Set['unique'] = set()
-        for sentence in annotation['sentences']:
-            tokens = sentence['tokens']
-            for triple in sentence['openie']:
-                new_triple = {}
-                for field in ['subject', 'relation', 'object']:
-                    text = triple[field]
-                    s, e = triple[field + 'Span']
-                    s = tokens[s]['characterOffsetBegin']
-                    e = tokens[e - 1]['characterOffsetEnd']
-                    new_triple[field] = Span(text=text, start=s, end=e)
-                key = '\t'.join(['{}-{}'.format(new_triple[field].start, new_triple[field].end)
-                                 for field in ['subject', 'relation', 'object']])
-                if remove_dup and key in dup:
-                    continue
-                triples.append(Triple(**new_triple))
-                dup.add(key)
-        return triples
+        self.client = CoreNLPClient(annotators=['openie'], memory=memory, threads=threads, endpoint=endpoint)
+        self.session = None
+        self.cache = cache
+        self.request_timeout = request_timeout
+
+    def get_openie_with_boundary(self, annotation: Dict, remove_dup: bool = False,
+                                 line_starts: List[int] = None) -> Union[List[Triple], List[List[Triple]]]:
+        """
+        :param (list) line_starts: if the annotation packs several lines, the (UTF-16) offset where each line starts.
+        :return: the triples, or if line_starts is given, the triples of each line with offsets relative to the line.
+        """
+        if line_starts is None:
+            groups = [(annotation['sentences'], 0)]
+        else:
+            # Assign each sentence to the line its first token is in
+            groups = [([], start) for start in line_starts]
+            for sentence in annotation['sentences']:
+                if sentence['tokens']:
+                    i = bisect.bisect_right(line_starts, sentence['tokens'][0]['characterOffsetBegin']) - 1
+                    groups[i][0].append(sentence)
+        results = []
+        for sentences, offset in groups:
+            triples: List[Triple] = []
+            dup: Set['unique'] = set()
+            for sentence in sentences:
+                tokens = sentence['tokens']
+                for triple in sentence['openie']:
+                    new_triple = {}
+                    for field in ['subject', 'relation', 'object']:
+                        text = triple[field]
+                        s, e = triple[field + 'Span']
+                        s = tokens[s]['characterOffsetBegin'] - offset
+                        e = tokens[e - 1]['characterOffsetEnd'] - offset
+                        new_triple[field] = Span(text=text, start=s, end=e)
+                    key = '\t'.join(['{}-{}'.format(new_triple[field].start, new_triple[field].end)
+                                     for field in ['subject', 'relation', 'object']])
+                    if remove_dup and key in dup:
+                        continue
+                    triples.append(Triple(**new_triple))
+                    dup.add(key)
+            results.append(triples)
+        return results[0] if line_starts is None else results
 
     def annotate(self,
                  text: str,
@@ -102,14 +111,134 @@ class StanfordOpenIE:
         """
         if len(text) >= max_len:
             return []
+        variant = 'remove_dup' if remove_dup else ''
+        use_cache = self.cache is not None and simple_format and properties_key is None and properties is None
+        if use_cache:
+            triples = self.cache.get(text, variant)
+            if triples is not None:
+                return triples
         # https://stanfordnlp.github.io/CoreNLP/openie.html
         core_nlp_output = self.client.annotate(text=text, annotators=['openie'], output_format='json',
                                                properties_key=properties_key, properties=properties)
         if simple_format:
-            return self.get_openie_with_boundary(core_nlp_output, remove_dup=remove_dup)
+            triples = self.get_openie_with_boundary(core_nlp_output, remove_dup=remove_dup)
+            if use_cache:
+                self.cache.put(text, triples, variant)
+            return triples
         else:
             return core_nlp_output
 
+    def open_session(self, pool_size: int):
+        """Start the server if needed and open a pooled HTTP session for up to pool_size concurrent requests."""
+        self.client.ensure_alive()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+
+    def annotate_packed(self, texts: List[str], remove_dup: bool = False) -> List[List[Triple]]:
+        """Annotate several texts in a single CoreNLP request and split the triples back by text."""
+        line_starts, start = [], 0
+        for text in texts:
+            line_starts.append(start)
+            # CoreNLP character offsets count UTF-16 code units
+            start += len(text.encode('utf-16-le')) // 2 + 1
+        properties = {'annotators': 'openie', 'outputFormat': 'json', 'ssplit.newlineIsSentenceBreak': 'always'}
+        start = time.perf_counter()
+        r = self.session.post(self.client.endpoint, params={'properties': str(properties)},
+                              data='\n'.join(texts).encode('utf-8'), timeout=self.request_timeout)
+        r.raise_for_status()
+        if profiler.enabled:
+            profiler.observe('corenlp_request', time.perf_counter() - start)
+            profiler.stage('corenlp requests', len(texts), sum(len(text) for text in texts))
+        return self.get_openie_with_boundary(r.json(), remove_dup=remove_dup, line_starts=line_starts)
+
+    def annotate_batch(self,
+                       items: Iterable[Tuple[str, str]],
+                       batch_size: int = 32,
+                       max_chars: int = 50000,
+                       concurrency: int = 4,
+                       remove_dup: bool = False,
+                       max_len: int = 15000,
+                       retries: int = 2,
+                       on_skip: Callable[[int, str, str], None] = None) -> Iterator[Tuple[str, List[Triple]]]:
+        """
+        :param items: (id, text) pairs to annotate
+        :param (int) batch_size: max number of texts packed into one CoreNLP request
+        :param (int) max_chars: max number of characters packed into one CoreNLP request
+        :param (int) concurrency: number of requests in flight at once
+        :param (int) retries: number of times a failed request is retried before its texts are annotated one by one
+        :param on_skip: called with (index, id, reason) for each text that was retried ('retry') or too long
+            ('max_len'). Texts that are too long get no triples.
+        :return: (id, triples) for every item, in input order.
+        :raises: the last error of a text that still fails when annotated alone, once the items before it are yielded.
+        """
+        if self.session is None:
+            self.open_session(concurrency)
+
+        variant = 'remove_dup' if remove_dup else ''
+
+        def batches():
+            batch, n_chars = [], 0
+            for id, text in items:
+                if batch and (len(batch) >= batch_size or n_chars + len(text) > max_chars):
+                    yield batch
+                    batch, n_chars = [], 0
+                cached = self.cache.get(text, variant) if self.cache is not None and len(text) < max_len else None
+                batch.append((id, text, cached))
+                if len(text) < max_len and cached is None:
+                    n_chars += len(text)
+            if batch:
+                yield batch
+
+        def with_retries(texts):
+            for attempt in range(retries + 1):
+                try:
+                    return self.annotate_packed(texts, remove_dup=remove_dup), attempt
+                except (requests.RequestException, ValueError):
+                    if attempt == retries:
+                        raise
+                    time.sleep(2 ** attempt)
+
+        def run_batch(batch):
+            todo = [text for _, text, cached in batch if len(text) < max_len and cached is None]
+            try:
+                results, attempts = with_retries(todo) if todo else ([], 0)
+                statuses = ['retry' if attempts else 'ok'] * len(results)
+            except (requests.RequestException, ValueError):
+                # Annotate the texts one by one so a single bad sentence does not fail the whole batch
+                results, statuses = [], []
+                for text in todo:
+                    [triples], _ = with_retries([text])
+                    results.append(triples)
+                    statuses.append('retry')
+            results, statuses = iter(results), iter(statuses)
+            return [(id, text, cached, 'cached') if cached is not None else
+                    (id, text, next(results), next(statuses)) if len(text) < max_len else
+                    (id, text, [], 'max_len')
+                    for id, text, cached in batch]
+
+        def finish(future):
+            for id, text, triples, status in future.result():
+                if profiler.enabled:
+                    profiler.add('oie sentences', status)
+                if status in ('ok', 'retry') and self.cache is not None:
+                    self.cache.put(text, triples, variant)
+                if status not in ('ok', 'cached') and on_skip is not None:
+                    on_skip(next(index), id, status)
+                else:
+                    next(index)
+                yield id, triples
+
+        index = itertools.count()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            in_flight = deque()
+            for batch in batches():
+                in_flight.append(executor.submit(run_batch, batch))
+                if len(in_flight) >= concurrency:
+                    yield from finish(in_flight.popleft())
+            while in_flight:
+                yield from finish(in_flight.popleft())
+
     def __enter__(self):
         return self
 
@@ -119,7 +248,124 @@ class StanfordOpenIE:
     def __del__(self):
         if self.close_after_finish:
             self.client.stop()
-            del os.environ['CORENLP_HOME']
+            os.environ.pop('CORENLP_HOME', None)
+
+
+def load_checkpoint(path: str) -> Dict:
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as fin:
+        return json.load(fin)
+
+
+def save_checkpoint(path: str, ckpt: Dict):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fout:
+        json.dump(ckpt, fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp_path, path)
+
+
+def count_lines(path: str) -> int:
+    with open(path, 'r') as fin:
+        return sum(1 for _ in fin)
+
+
+def input_stat(path: str) -> List[int]:
+    """The size and modification time of an input, to tell whether a checkpoint still describes it."""
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class Checkpoint:
+    """The progress of annotating inp into out, saved to <out>.ckpt, with the skipped sentences in <out>.skipped.
+
+    The number of input lines done and the offsets of the output (if it is a text file) and of the
+    sidecar are committed together, so a resumed run drops anything written after the last commit.
+    The checkpoint is discarded if the size or modification time of the input changed since.
+    Use it as a context manager to open the output and the sidecar at those offsets.
+    """
+
+    def __init__(self, inp: str, out: str, resume: bool, text_output: bool = True):
+        self.inp, self.out, self.path, self.skip_path = inp, out, out + '.ckpt', out + '.skipped'
+        self.text_output = text_output
+        self.fout, self.skip_f = None, None
+        self.ckpt = load_checkpoint(self.path) if resume else None
+        stat = input_stat(inp)
+        if self.ckpt is not None and self.ckpt.get('inp_stat') != stat:
+            print('{} changed since {} was checkpointed, starting over'.format(inp, out))
+            self.ckpt = None
+        if self.ckpt is None:
+            self.ckpt = {'inp': inp, 'inp_stat': stat, 'lines': 0, 'out_offset': 0, 'skip_offset': 0, 'done': False}
+            open(self.skip_path, 'w').close()
+            if text_output:
+                open(out, 'w').close()
+        elif not self.done:
+            print('resuming {} from line {}'.format(out, self.lines))
+        if text_output and self._rollback_errors():
+            print('re-annotating {} from line {}, which failed before'.format(out, self.lines))
+
+    @property
+    def done(self) -> bool:
+        return self.ckpt.get('done', False)
+
+    @property
+    def lines(self) -> int:
+        return self.ckpt['lines']
+
+    def __enter__(self):
+        # Drop anything written after the last checkpoint, and skip the input lines it covers
+        self.skip_f = open(self.skip_path, 'r+')
+        self.skip_f.seek(self.ckpt['skip_offset'])
+        self.skip_f.truncate()
+        if self.text_output:
+            self.fout = open(self.out, 'r+')
+            self.fout.seek(self.ckpt['out_offset'])
+            self.fout.truncate()
+        return self.fout, self.skip_f
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for f in (self.fout, self.skip_f):
+            if f is not None:
+                f.close()
+        self.fout, self.skip_f = None, None
+
+    def _rollback_errors(self) -> bool:
+        """Move the checkpoint back to the first sentence that failed ('error' in the sidecar) in an older run."""
+        with open(self.skip_path, 'rb') as fin:
+            skip_offset = 0
+            for entry in fin:
+                if skip_offset >= self.ckpt['skip_offset']:
+                    return False
+                if entry.rstrip(b'\n').rsplit(b'\t', 1)[-1] == b'error':
+                    break
+                skip_offset += len(entry)
+            else:
+                return False
+        line = int(entry.split(b'\t', 1)[0])
+        with open(self.out, 'rb') as fin:
+            out_offset = sum(len(l) for l in itertools.islice(fin, line))
+        self.ckpt.update(lines=line, out_offset=out_offset, skip_offset=skip_offset, done=False)
+        return True
+
+    def commit(self, lines: int):
+        for f in (self.fout, self.skip_f):
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+        self.ckpt.update(lines=lines, skip_offset=self.skip_f.tell())
+        if self.fout is not None:
+            self.ckpt['out_offset'] = self.fout.tell()
+        save_checkpoint(self.path, self.ckpt)
+
+    def finish(self, lines: int):
+        """Mark the run as done, only if the output is aligned with the input."""
+        inp_lines = count_lines(self.inp)
+        if lines != inp_lines:
+            raise RuntimeError('{} has {} lines but {} has {}'.format(self.out, lines, self.inp, inp_lines))
+        self.ckpt.update(lines=lines, done=True)
+        save_checkpoint(self.path, self.ckpt)
 
 
 def filter_relation(relation: str):
@@ -129,21 +375,79 @@ def filter_relation(relation: str):
         return False
     if relation[0] in punct:  # start with punct
         return False
-    if np.all([w in stopwords for w in toks]):  # all tokens are stopwords
+    if stopwords.issuperset(toks):  # all tokens are stopwords
         return False
     if len(toks) > 10:  # too long
         return False
     return True
 
 
+def filter_relations(relations: List[str]) -> List[bool]:
+    return [filter_relation(r) for r in relations]
+
+
+def shortest_triple(path: str, chunk: Tuple[int, int]) -> str:
+    """Map step of the filter task: the lines of a chunk of a .oie file or store with only their shortest triple."""
+    out = []
+    if os.path.isdir(path):
+        reader = OIEStoreReader(path)
+        for i in range(*chunk):
+            rows = reader.span_array(i)
+            triples = []
+            if len(rows):
+                lens = rows[:, 2] - rows[:, 1] + rows[:, 5] - rows[:, 4] + rows[:, 8] - rows[:, 7]
+                row = rows[int(np.argmin(lens))]
+                triples = [Triple(*[Span(reader.string(row[j]), int(row[j + 1]), int(row[j + 2])) for j in (0, 3, 6)])]
+            out.append('{}\t{}\n'.format(reader.id(i), triples_to_str(triples)))
+    else:
+        for id, text in read_oie_lines(path, *chunk):
+            best, best_len = '', None
+            for t in (text.split('\t') if text else []):
+                l = sum(span_len(span) for span in t.split('|||'))
+                if best_len is None or l < best_len:
+                    best, best_len = t, l
+            out.append('{}\t{}\n'.format(id, best))
+    return ''.join(out)
+
+
+def count_relations(path: str, chunk: Tuple[int, int]) -> Counter:
+    """Map step of the ana task: the count of each relation in a chunk, in the order they first appear."""
+    counts = Counter()
+    if os.path.isdir(path):
+        reader = OIEStoreReader(path)
+        rel_ids = reader.spans[reader.sent_index[chunk[0]]:reader.sent_index[chunk[1]], 3]
+        uniq, first, cnts = np.unique(rel_ids, return_index=True, return_counts=True)
+        for k in np.argsort(first, kind='stable'):
+            counts[reader.string(uniq[k])] = int(cnts[k])
+    else:
+        for _, text in read_oie_lines(path, *chunk):
+            if text:
+                for t in text.split('\t'):
+                    counts[span_text(t.split('|||', 2)[1])] += 1
+    return counts
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='run open ie on a text file')
-    parser.add_argument('--task', type=str, choices=['run', 'filter', 'ana'], default='run')
+    parser.add_argument('--task', type=str, choices=['run', 'check', 'filter', 'ana'], default='run')
     parser.add_argument('--inp', type=str, help='input file')
     parser.add_argument('--out', type=str, help='output file')
     parser.add_argument('--threads', type=int, help='number of threads for standford nlp', default=5)
     parser.add_argument('--start_server', action='store_true')
+    parser.add_argument('--batch_size', type=int, help='number of sentences packed into one CoreNLP request', default=32)
+    parser.add_argument('--concurrency', type=int, help='number of CoreNLP requests in flight at once', default=5)
+    parser.add_argument('--cache', type=str, help='sqlite file caching the triples of sentences seen before')
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted run from its last checkpoint')
+    parser.add_argument('--checkpoint_every', type=int, help='number of output lines between checkpoints', default=1000)
+    parser.add_argument('--out_format', type=str, choices=['text', 'store'], default='text',
+                        help='write triples as a text .oie file or a binary store directory (see oie_format.py)')
+    parser.add_argument('--workers', type=int, help='number of processes for the filter and ana tasks', default=1)
+    parser.add_argument('--chunk_mb', type=int, help='size of the input chunks of the filter and ana tasks in MB', default=32)
+    parser.add_argument('--profile', type=str, help='write a profile (request latencies, skipped sentences) to this .json or .csv file')
+    parser.add_argument('--profile_every', type=float, help='also write the profile every this many seconds', default=0)
     args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile, args.profile_every)
 
     if args.task == 'run':
         if args.start_server:
@@ -151,30 +455,80 @@ if __name__ == '__main__':
                 client.annotate('dummy test.', remove_dup=True)
             exit(0)
 
-        with open(args.inp, 'r') as fin, open(args.out, 'w') as fout, \
-                StanfordOpenIE(threads=args.threads, close_after_finish=True) as client:
-            for lid, line in tqdm(enumerate(fin)):
-                id, text = line.strip().split('\t')
-                triples = client.annotate(text, remove_dup=False)
-                fout.write('{}\t{}\n'.format(id, triples_to_str(triples)))
-
-    elif args.task == 'filter':
-        with open(args.inp, 'r') as fin, open(args.out, 'w') as fout:
-            for l in tqdm(fin):
-                id, text = l.rstrip('\n').split('\t', 1)
-                triples = sorted(str_to_triples(text), key=lambda t: get_triple_len(t))
-                fout.write('{}\t{}\n'.format(id, triples_to_str(triples[:1])))
-
-    elif args.task == 'ana':
-        relation2count = defaultdict(lambda: 0)
-        with open(args.inp, 'r') as fin:
-            for l in fin:
-                for t in str_to_triples(l.rstrip('\n')):
-                    relation2count[t.relation.text] += 1
-        relation2count = list(filter(lambda x: filter_relation(x[0]),
-                                     sorted(relation2count.items(), key=lambda x: -x[1])))
-        print('#relation {}'.format(len(relation2count)))
-        print(relation2count[:5])
-        with open(args.out, 'w') as fout:
-            for r, c in relation2count:
-                fout.write('{}\t{}\n'.format(r, c))
+        if args.resume and args.out_format == 'store':
+            parser.error('--resume is only supported with --out_format text')
+        ckpt = Checkpoint(args.inp, args.out, args.resume, text_output=args.out_format == 'text')
+        if ckpt.done:
+            print('{} is already complete'.format(args.out))
+            exit(0)
+
+        cache = OIECache(args.cache, namespace=CORE_NLP_VERSION) if args.cache else None
+        with open(args.inp, 'r') as fin, ckpt as (text_fout, skip_f), \
+                (OIEStoreWriter(args.out) if args.out_format == 'store' else nullcontext(text_fout)) as fout, \
+                StanfordOpenIE(threads=args.threads, close_after_finish=True, cache=cache) as client:
+            start_line = ckpt.lines
+            items = (line.strip().split('\t') for line in itertools.islice(fin, start_line, None))
+            on_skip = lambda i, id, reason: skip_f.write('{}\t{}\t{}\n'.format(start_line + i, id, reason))
+
+            lines = start_line
+            for id, triples in tqdm(client.annotate_batch(items, batch_size=args.batch_size, concurrency=args.concurrency,
+                                                          remove_dup=False, on_skip=on_skip), initial=start_line):
+                if args.out_format == 'store':
+                    fout.add(id, triples)
+                else:
+                    fout.write('{}\t{}\n'.format(id, triples_to_str(triples)))
+                lines += 1
+                if args.out_format == 'text' and lines % args.checkpoint_every == 0:
+                    ckpt.commit(lines)
+            if args.out_format == 'text':
+                ckpt.commit(lines)
+        if cache is not None:
+            print(cache.stats())
+            cache.close()
+        ckpt.finish(lines)
+
+    elif args.task == 'check':
+        # Verify that a run finished and that its output is aligned with its input
+        ckpt = load_checkpoint(args.out + '.ckpt')
+        inp_lines = count_lines(args.inp)
+        out_lines = len(OIEStoreReader(args.out)) if os.path.isdir(args.out) else count_lines(args.out)
+        with open(args.out + '.skipped', 'r') as fin:
+            skipped = [l.rstrip('\n').split('\t') for l in fin]
+        reasons = Counter(r for _, _, r in skipped)
+        print('{}: {} input lines, {} output lines, {} retried/skipped'.format(args.out, inp_lines, out_lines, len(skipped)))
+        for reason, count in sorted(reasons.items()):
+            print('  {}: {}'.format(reason, count))
+        if reasons['error']:
+            print('{} has sentences that failed, rerun with --resume to annotate them'.format(args.out))
+            exit(1)
+        if ckpt is None or not ckpt.get('done') or ckpt.get('inp_stat') != input_stat(args.inp) or inp_lines != out_lines:
+            print('{} is incomplete, misaligned with {} or older than it'.format(args.out, args.inp))
+            exit(1)
+
+    elif args.task in {'filter', 'ana'}:
+        # Map over chunks of the input in a pool of processes, then merge the partial results in input order
+        chunks = split_oie(args.inp, args.chunk_mb << 20)
+        pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
+        imap = pool.imap if pool else map
+        if args.task == 'filter':
+            with open(args.out, 'w') as fout:
+                for chunk, lines in tqdm(zip(chunks, imap(partial(shortest_triple, args.inp), chunks)), total=len(chunks)):
+                    fout.write(lines)
+                    profiler.stage('filter chunks', 1, chunk[1] - chunk[0])
+        else:
+            relation2count = Counter()
+            for chunk, counts in tqdm(zip(chunks, imap(partial(count_relations, args.inp), chunks)), total=len(chunks)):
+                relation2count.update(counts)
+                profiler.stage('ana chunks', 1, chunk[1] - chunk[0])
+            relation2count = sorted(relation2count.items(), key=lambda x: -x[1])
+            batches = [[r for r, _ in relation2count[i:i + 100000]] for i in range(0, len(relation2count), 100000)]
+            keep = [k for ks in imap(filter_relations, batches) for k in ks]
+            relation2count = [rc for rc, k in zip(relation2count, keep) if k]
+            print('#relation {}'.format(len(relation2count)))
+            print(relation2count[:5])
+            with open(args.out, 'w') as fout:
+                for r, c in relation2count:
+                    fout.write('{}\t{}\n'.format(r, c))
+        if pool:
+            pool.close()
+            pool.join()
@@ -0,0 +1,171 @@
+'''
+Streaming end-to-end pipeline, from the CORD-19 JSON files to the HTML reports.
+
+This runs the same steps as extract_text.sh, oie.sh and extraction/extract_from_templates.py, but
+the stages (text extraction and sentence segmentation, OpenIE, template matching) run concurrently
+and hand sentences to each other through bounded queues instead of files, so the reports are
+refreshed as soon as the first sentences are annotated. Writing the intermediate .txt/.sent/.oie
+files is optional (--out_prefixes).
+'''
+from typing import Iterator, List, Tuple
+from collections import deque
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import time
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'oie'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extraction'))
+from sentence_seg import init_worker, segment_files, walk_files
+from stanford_oie import StanfordOpenIE
+from oie_format import triples_to_str
+from oie_scheduler import ServerStats, annotate_chunks
+from metadata_index import open_metadata_index
+from result_store import LineSpill, ResultStore
+import extract_from_templates
+import profiling
+from profiling import profiler
+
+
+def segment_dirs(root_dirs: List[str], pool, window: int, out_prefixes: List[str], chunk_chars: int,
+                 max_chunk_lines: int) -> Iterator[List[Tuple[Tuple[int, int], str, str]]]:
+  """Segment the JSON files of each directory and yield chunks of ((file id, line id), paper id, sentence).
+
+  The file id is the index of the directory and the line id the index of the sentence in it, i.e.
+  the line of the sentence in the .sent file that sentence_seg.py would write for the directory.
+  """
+  for file_id, root_dir in enumerate(root_dirs):
+    text_fout = open(out_prefixes[file_id] + '.txt', 'w') if out_prefixes else None
+    sent_fout = open(out_prefixes[file_id] + '.sent', 'w') if out_prefixes else None
+    chunk, n_chars, line_id = [], 0, 0
+    for file, texts, sents in segment_files(walk_files(root_dir), pool, window):
+      for text, para_sents in zip(texts, sents):
+        if text_fout:
+          text_fout.write('{}\t{}\n'.format(file, text))
+        for sent in para_sents:
+          if sent_fout:
+            sent_fout.write('{}\t{}\n'.format(file, sent))
+          chunk.append(((file_id, line_id), file, sent))
+          n_chars += len(sent)
+          line_id += 1
+          if n_chars >= chunk_chars or len(chunk) >= max_chunk_lines:
+            yield chunk
+            chunk, n_chars = [], 0
+    if chunk:
+      yield chunk
+    for f in (text_fout, sent_fout):
+      if f:
+        f.close()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Run text extraction, OpenIE and template extraction as one streaming pipeline')
+  parser.add_argument('--root_dirs', type=str, nargs='+', required=True, help='Directories of JSON files (e.g. pdf_json)')
+  parser.add_argument('--template_file', type=str, required=True, help='The templates to extract')
+  parser.add_argument('--tasks', type=int, nargs='+', default=None, help='Which tasks to do (if not specified, all)')
+  parser.add_argument('--html_dir', type=str, required=True, help='The directory where we output the reports')
+  parser.add_argument('--raw_data_dir', type=str, required=True, help='The directory with the metadata.csv of the release')
+  parser.add_argument('--metadata_index', type=str, default=None, help='The metadata index to use, built from metadata.csv if needed (default: metadata.db in raw_data_dir)')
+  parser.add_argument('--out_prefixes', type=str, nargs='+', default=None, help='If given, also write <prefix>.txt/.sent/.oie for each root dir')
+  parser.add_argument('--seg_workers', type=int, default=1, help='Number of processes to segment files with')
+  parser.add_argument('--seg_batch_size', type=int, default=64, help='Number of paragraphs per nlp.pipe batch')
+  parser.add_argument('--servers', type=int, default=4, help='Number of CoreNLP servers to start')
+  parser.add_argument('--port', type=int, default=9000, help='Port of the first server (the others use the following ports)')
+  parser.add_argument('--threads', type=int, default=5, help='Number of threads for each CoreNLP server')
+  parser.add_argument('--memory', type=str, default='8G', help='Memory of each CoreNLP server')
+  parser.add_argument('--concurrency', type=int, default=5, help='Number of requests in flight to each server')
+  parser.add_argument('--batch_size', type=int, default=32, help='Number of sentences packed into one CoreNLP request')
+  parser.add_argument('--chunk_chars', type=int, default=20000, help='Number of characters handed out to a server at once')
+  parser.add_argument('--max_len', type=int, default=15000, help='Sentences this long or longer get no triples')
+  parser.add_argument('--match_workers', type=int, default=1, help='Number of processes to match templates with')
+  parser.add_argument('--report_every', type=float, default=300, help='Seconds between refreshes of the reports')
+  parser.add_argument('--work_dir', type=str, default=None, help='Where to keep the results and the sentences they refer to (default: html_dir)')
+  parser.add_argument('--memory_budget', type=int, default=1000000, help='Number of results kept in memory before they are written to the result store')
+  parser.add_argument('--page_size', type=int, default=200, help='Number of results on each report page')
+  parser.add_argument('--max_per_key', type=int, default=100, help='Number of sentences shown for each result')
+  parser.add_argument('--profile', type=str, default=None, help='Write a profile of the stages, CoreNLP requests and templates to this .json or .csv file')
+  parser.add_argument('--profile_every', type=float, default=0, help='Also write the profile every this many seconds')
+  args = parser.parse_args()
+  if args.profile:
+    profiling.enable(args.profile, args.profile_every)
+  if args.out_prefixes and len(args.out_prefixes) != len(args.root_dirs):
+    raise ValueError('Lengths of the args.out_prefixes and args.root_dirs arguments must be the same')
+
+  extract_from_templates.metadata = open_metadata_index(f'{args.raw_data_dir}/metadata.csv', args.metadata_index or f'{args.raw_data_dir}/metadata.db')
+  with open(args.template_file, 'r') as f:
+    csvf = csv.reader(f)
+    text_header = next(csvf)
+    temp_data = list(csvf)
+    if args.tasks is not None:
+      temp_data = [temp_data[i] for i in args.tasks]
+  work_dir = args.work_dir or args.html_dir
+  os.makedirs(work_dir, exist_ok=True)
+  store = ResultStore(os.path.join(work_dir, 'results.db'), args.memory_budget)
+  # The sentences that mention the virus are the only ones a result can refer to
+  spill = LineSpill(os.path.join(work_dir, 'results.sent'), len(args.root_dirs))
+  extractor = extract_from_templates.TemplateExtractor(temp_data, store)
+
+  def write_reports():
+    extract_from_templates.write_reports(args.html_dir, temp_data, extractor.text_regexes, extractor.oie_regexes,
+                                         store, spill, args.page_size, args.max_per_key)
+
+  # Start the process pools before any thread
+  init_worker(args.seg_batch_size)
+  seg_pool = multiprocessing.Pool(args.seg_workers, initializer=init_worker, initargs=(args.seg_batch_size,)) if args.seg_workers > 1 else None
+  match_pool = multiprocessing.Pool(args.match_workers, initializer=extract_from_templates.init_shard_worker, initargs=(temp_data, None)) if args.match_workers > 1 else None
+
+  clients = [StanfordOpenIE(threads=args.threads, close_after_finish=True, memory=args.memory,
+                            endpoint='http://localhost:{}'.format(args.port + i)) for i in range(args.servers)]
+  for client in clients:
+    client.open_session(args.concurrency)
+  oie_fouts = [open(prefix + '.oie', 'w') for prefix in args.out_prefixes] if args.out_prefixes else None
+  skip_fouts = [open(prefix + '.oie.skipped', 'w') for prefix in args.out_prefixes] if args.out_prefixes else None
+
+  start = last_report = time.time()
+  stats = ServerStats()
+  chunks = segment_dirs(args.root_dirs, seg_pool, max(args.seg_workers, 1) * 16, args.out_prefixes,
+                        args.chunk_chars, args.batch_size * 8)
+  in_flight = deque()
+  with tqdm(desc='sentences') as pbar:
+    for chunk, results, skipped in annotate_chunks(clients, chunks, args.batch_size, args.concurrency, args.max_len, stats):
+      profiler.stage('oie', len(chunk), sum(len(sent) for _, _, sent in chunk))
+      lines = []
+      for ((file_id, line_id), id, sent), (_, triples) in zip(chunk, results):
+        oie_line = '{}\t{}\n'.format(id, triples_to_str(triples))
+        if oie_fouts:
+          oie_fouts[file_id].write(oie_line)
+        text_line = '{}\t{}\n'.format(id, sent)
+        if extract_from_templates.v_reg_comp.search(text_line):
+          spill.add(file_id, line_id, text_line)
+        lines.append((file_id, line_id, text_line, oie_line))
+      if skip_fouts:
+        for (file_id, line_id), id, reason in skipped:
+          skip_fouts[file_id].write('{}\t{}\t{}\n'.format(line_id, id, reason))
+      if match_pool:
+        # Partial results are merged in order, and at most a few chunks wait to be matched
+        in_flight.append(match_pool.apply_async(extract_from_templates.match_lines, (lines,)))
+        while in_flight and (len(in_flight) >= args.match_workers * 4 or in_flight[0].ready()):
+          extractor.merge(*in_flight.popleft().get())
+      else:
+        for line in lines:
+          extractor.process_line(*line)
+      pbar.update(len(lines))
+      if time.time() - last_report >= args.report_every:
+        write_reports()
+        last_report = time.time()
+  while in_flight:
+    extractor.merge(*in_flight.popleft().get())
+  write_reports()
+  spill.close()
+  store.close()
+
+  for f in (oie_fouts or []) + (skip_fouts or []):
+    f.close()
+  for pool in (seg_pool, match_pool):
+    if pool:
+      pool.close()
+      pool.join()
+  print(stats.report(time.time() - start, args.concurrency), file=sys.stderr)
@@ -0,0 +1,139 @@
+'''
+Opt-in profiling shared by the extraction, OIE and retrieval scripts.
+
+Counters and timers are recorded into rows (e.g. one per template), latencies into histograms and
+item counts into stages. Nothing is recorded unless `enable` was called (the scripts do so with
+--profile), and the profile is written as JSON or CSV (by the extension of the path) at exit and,
+optionally, every few seconds while the script runs.
+'''
+from typing import Dict
+from collections import defaultdict
+import atexit
+import csv
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in milliseconds
+buckets_ms = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000, float('inf')]
+
+
+class Profiler:
+  def __init__(self):
+    self.enabled = False
+    self.path = None
+    self.lock = threading.Lock()
+    # Only one dump (periodic or at exit) writes the file at a time
+    self.dump_lock = threading.Lock()
+    self.start = time.time()
+    self.rows = defaultdict(lambda: defaultdict(lambda: 0))
+    self.labels = defaultdict(dict)
+    self.hists = defaultdict(lambda: [0] * len(buckets_ms))
+    self.stages = defaultdict(lambda: [0, 0.0])
+
+  def add(self, row: str, field: str, value: float = 1):
+    """Add to a counter or a timer (in seconds) of a row."""
+    with self.lock:
+      self.rows[row][field] += value
+
+  def label(self, row: str, field: str, value: str):
+    self.labels[row][field] = value
+
+  def observe(self, hist: str, seconds: float):
+    """Add a latency to a histogram."""
+    ms = seconds * 1000
+    with self.lock:
+      h = self.hists[hist]
+      for i, bound in enumerate(buckets_ms):
+        if ms <= bound:
+          h[i] += 1
+          break
+
+  def stage(self, stage: str, items: int, size: int = 0):
+    """Count the items (and their size, e.g. in bytes) processed by a stage, to report its throughput."""
+    with self.lock:
+      self.stages[stage][0] += items
+      self.stages[stage][1] += size
+
+  def take(self) -> Dict:
+    """The counts recorded since the last call, e.g. to send them from a worker process to `merge`."""
+    with self.lock:
+      data = {'rows': {r: dict(f) for r, f in self.rows.items()}, 'labels': dict(self.labels),
+              'hists': dict(self.hists), 'stages': {s: list(v) for s, v in self.stages.items()}}
+      self.rows.clear()
+      self.labels.clear()
+      self.hists.clear()
+      self.stages.clear()
+    return data
+
+  def merge(self, data: Dict):
+    if not data:
+      return
+    with self.lock:
+      for r, fields in data['rows'].items():
+        for f, v in fields.items():
+          self.rows[r][f] += v
+      for r, fields in data['labels'].items():
+        self.labels[r].update(fields)
+      for name, h in data['hists'].items():
+        self.hists[name] = [a + b for a, b in zip(self.hists[name], h)]
+      for s, (items, size) in data['stages'].items():
+        self.stages[s][0] += items
+        self.stages[s][1] += size
+
+  def report(self) -> Dict:
+    elapsed = time.time() - self.start
+    with self.lock:
+      # Labelled rows are reported even if nothing was recorded for them, e.g. templates that never matched
+      rows = {r: dict(self.labels.get(r, {}), **self.rows.get(r, {})) for r in list(self.labels) + list(self.rows)}
+      stages = {s: {'items': items, 'size': size, 'items_per_sec': items / max(elapsed, 1e-9),
+                    'size_per_sec': size / max(elapsed, 1e-9)} for s, (items, size) in self.stages.items()}
+      hists = {name: {'le_{}ms'.format(b): c for b, c in zip(buckets_ms, h)} for name, h in self.hists.items()}
+    return {'elapsed': elapsed, 'stages': stages, 'histograms': hists, 'rows': rows}
+
+  def dump(self):
+    """Write the profile to the path, as CSV with one line per row, stage and histogram if it ends with .csv."""
+    if not self.enabled:
+      return
+    report = self.report()
+    tmp_path = self.path + '.tmp'
+    with self.dump_lock:
+      with open(tmp_path, 'w') as fout:
+        if self.path.endswith('.csv'):
+          lines = [dict(fields, name=r) for r, fields in report['rows'].items()]
+          lines += [dict(fields, name='stage ' + s) for s, fields in report['stages'].items()]
+          lines += [dict(fields, name='histogram ' + h) for h, fields in report['histograms'].items()]
+          columns = ['name'] + sorted({c for l in lines for c in l} - {'name'})
+          writer = csv.DictWriter(fout, fieldnames=columns)
+          writer.writeheader()
+          writer.writerows(lines)
+        else:
+          json.dump(report, fout, indent=1)
+      # Replace the previous dump at once so it can be read while the script runs
+      os.replace(tmp_path, self.path)
+
+  def reset_locks(self):
+    """Replace the locks in a forked child, where the thread that held them (e.g. the periodic dump) does not exist."""
+    self.lock = threading.Lock()
+    self.dump_lock = threading.Lock()
+
+
+profiler = Profiler()
+if hasattr(os, 'register_at_fork'):
+  # Worker pools may fork while the periodic dump holds a lock, which would then never be released in the worker
+  os.register_at_fork(after_in_child=lambda: profiler.reset_locks())
+
+
+def enable(path: str, dump_every: float = 0):
+  """Start recording, and write the profile to path at exit and every dump_every seconds if it is positive."""
+  profiler.enabled = True
+  profiler.path = path
+  profiler.start = time.time()
+  atexit.register(profiler.dump)
+  if dump_every > 0:
+    def dump_periodically():
+      while True:
+        time.sleep(dump_every)
+        profiler.dump()
+    threading.Thread(target=dump_periodically, daemon=True).start()
@@ -0,0 +1,135 @@
+from typing import Dict, List, Tuple
+import json
+import math
+import os
+import string
+import sys
+from abc import ABC, abstractmethod
+from array import array
+from collections import Counter, defaultdict
+import numpy as np
+from tqdm import tqdm
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'extraction'))
+from line_index import iter_line_offsets
+
+
+PUNCT_TO_SPACE = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
+
+
+class Searcher(ABC):
+    """The interface of a search backend. Results are (source, score) pairs where the source has the
+    `file`, `line_id` and `sentence` of a line, like the documents in the Elasticsearch index."""
+    max_len_query = 1024
+
+    def clean_query(self, query_str: str):
+        new_query_str = query_str.translate(PUNCT_TO_SPACE)
+        new_query_str = new_query_str.replace(' AND ', ' ').replace(' and ', ' ')
+        return new_query_str[:self.max_len_query]
+
+    @abstractmethod
+    def get_topk(self, query_str: str, field: str, topk: int=5) -> List[Tuple[Dict, float]]:
+        pass
+
+    def get_topk_batch(self, query_strs: List[str], field: str, topk: int=5) -> List[List[Tuple[Dict, float]]]:
+        return [self.get_topk(query_str, field, topk=topk) for query_str in query_strs]
+
+
+def tokenize(text: str) -> List[str]:
+    return text.translate(PUNCT_TO_SPACE).lower().split()
+
+
+def build_local_index(files: List[str], index_dir: str):
+    """Build an inverted index over the lines of the files, stored as arrays that are memory-mapped at query time.
+
+    The postings of each term are sorted document ids (int32) and term frequencies (uint16), stored
+    back to back for all terms in `postings_docs.npy`/`postings_tfs.npy`.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    doc_ids: Dict[str, array] = defaultdict(lambda: array('i'))
+    tfs: Dict[str, array] = defaultdict(lambda: array('H'))
+    doc_lens, doc_files, doc_lines, doc_offsets = array('i'), array('i'), array('q'), array('q')
+    n_docs = 0
+    for file_id, file in enumerate(files):
+        for i, (offset, l) in tqdm(enumerate(iter_line_offsets(file))):
+            tokens = tokenize(l.decode('utf-8'))
+            for term, tf in Counter(tokens).items():
+                doc_ids[term].append(n_docs)
+                tfs[term].append(min(tf, 65535))
+            doc_lens.append(len(tokens))
+            doc_files.append(file_id)
+            doc_lines.append(i)
+            doc_offsets.append(offset)
+            n_docs += 1
+
+    terms = sorted(doc_ids)
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum([len(doc_ids[t]) for t in terms], out=term_offsets[1:])
+    postings_docs = np.lib.format.open_memmap(os.path.join(index_dir, 'postings_docs.npy'), mode='w+',
+                                              dtype=np.int32, shape=(int(term_offsets[-1]),))
+    postings_tfs = np.lib.format.open_memmap(os.path.join(index_dir, 'postings_tfs.npy'), mode='w+',
+                                             dtype=np.uint16, shape=(int(term_offsets[-1]),))
+    for i, t in enumerate(terms):
+        postings_docs[term_offsets[i]:term_offsets[i + 1]] = np.frombuffer(doc_ids.pop(t), dtype=np.int32)
+        postings_tfs[term_offsets[i]:term_offsets[i + 1]] = np.frombuffer(tfs.pop(t), dtype=np.uint16)
+    postings_docs.flush()
+    postings_tfs.flush()
+    np.save(os.path.join(index_dir, 'term_offsets.npy'), term_offsets)
+    for name, arr, dtype in [('doc_lens', doc_lens, np.int32), ('doc_files', doc_files, np.int32),
+                             ('doc_lines', doc_lines, np.int64), ('doc_offsets', doc_offsets, np.int64)]:
+        np.save(os.path.join(index_dir, name + '.npy'), np.frombuffer(arr, dtype=dtype))
+    with open(os.path.join(index_dir, 'terms.txt'), 'w') as fout:
+        for t in terms:
+            fout.write(t + '\n')
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as fout:
+        json.dump({'files': files, 'n_docs': n_docs}, fout)
+
+
+class LocalSearcher(Searcher):
+    """BM25 search in-process over an index built by `build_local_index`, with Lucene's default k1 and b."""
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, index_dir: str):
+        load = lambda name: np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r')
+        self.postings_docs = load('postings_docs')
+        self.postings_tfs = load('postings_tfs')
+        self.term_offsets = load('term_offsets')
+        self.doc_lens = load('doc_lens')
+        self.doc_files = load('doc_files')
+        self.doc_lines = load('doc_lines')
+        self.doc_offsets = load('doc_offsets')
+        with open(os.path.join(index_dir, 'terms.txt'), 'r') as fin:
+            self.term_ids = {t.rstrip('\n'): i for i, t in enumerate(fin)}
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as fin:
+            meta = json.load(fin)
+        self.files = meta['files']
+        self.n_docs = meta['n_docs']
+        self.avg_len = float(np.mean(self.doc_lens)) if self.n_docs else 0.0
+
+    def sentence(self, doc: int) -> str:
+        with open(self.files[self.doc_files[doc]], 'rb') as fin:
+            fin.seek(int(self.doc_offsets[doc]))
+            return fin.readline().rstrip(b'\n').split(b'\r', 1)[0].decode('utf-8')
+
+    def get_topk(self, query_str: str, field: str, topk: int=5):
+        docs, scores = [], []
+        # Repeated query terms are counted once per occurrence, like the clauses of a query_string query
+        for term in tokenize(self.clean_query(query_str)):
+            tid = self.term_ids.get(term)
+            if tid is None:
+                continue
+            s, e = self.term_offsets[tid], self.term_offsets[tid + 1]
+            term_docs = self.postings_docs[s:e]
+            tf = self.postings_tfs[s:e].astype(np.float32)
+            idf = math.log(1 + (self.n_docs - (e - s) + 0.5) / ((e - s) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lens[term_docs] / self.avg_len)
+            docs.append(term_docs)
+            scores.append(idf * tf * (self.k1 + 1) / (tf + norm))
+        if not docs:
+            return []
+        docs, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(scores))
+        top = np.argpartition(-scores, topk - 1)[:topk] if len(scores) > topk else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [({'file': self.files[self.doc_files[docs[i]]], 'line_id': int(self.doc_lines[docs[i]]),
+                  'sentence': self.sentence(docs[i])}, float(scores[i])) for i in top]
@@ -1,29 +1,29 @@
 from typing import List, Tuple
 import argparse
+import hashlib
 import os
 import re
-import string
+import time
+import sys
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import parallel_bulk
+from backends import Searcher, LocalSearcher, build_local_index
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import profiling
+from profiling import profiler
 
 
-PUNCT_TO_SPACE = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
-
-
-class ESSearcher():
-    max_len_query = 1024
-
-    def __init__(self, index_name: str):
-        self.es = Elasticsearch()
+class ESSearcher(Searcher):
+    def __init__(self, index_name: str, es: Elasticsearch = None):
+        self.es = es or Elasticsearch()
         self.index_name = index_name
 
     def query_format(self, query_str: str, field: str):
-        new_query_str = query_str.translate(PUNCT_TO_SPACE)
         #new_query_str = ' '.join([w for w in new_query_str.split() if re.match('^[0-9A-Za-z]+$', w)])
-        new_query_str = new_query_str.replace(' AND ', ' ').replace(' and ', ' ')
-        q = '{}:({})'.format(field, new_query_str[:self.max_len_query])
+        q = '{}:({})'.format(field, self.clean_query(query_str))
         return q
 
     def get_topk(self, query_str: str, field: str, topk: int=5):
@@ -33,38 +33,137 @@ class ESSearcher():
             size=topk)['hits']['hits']
         return [(doc['_source'], doc['_score']) for doc in results]
 
+    def get_topk_batch(self, query_strs: List[str], field: str, topk: int=5):
+        """Like get_topk for several queries, sent in a single multi-search request."""
+        body = []
+        for query_str in query_strs:
+            body.append({'index': self.index_name})
+            body.append({'query': {'query_string': {'query': self.query_format(query_str, field)}}, 'size': topk})
+        responses = self.es.msearch(body=body)['responses']
+        results = []
+        for response in responses:
+            if 'error' in response:
+                raise RuntimeError('query failed: {}'.format(response['error']))
+            results.append([(doc['_source'], doc['_score']) for doc in response['hits']['hits']])
+        return results
+
 
-def gendata(files: List[str], index_name: str):
+def doc_id(file: str, line_id: int) -> str:
+    """A stable id for a line, so indexing the same line again overwrites (or skips) it."""
+    return hashlib.sha1('{}\t{}'.format(file, line_id).encode('utf-8')).hexdigest()
+
+
+def gendata(files: List[str], index_name: str, op_type: str = 'index'):
     for file in files:
         with open(file, 'r') as fin:
             for i, l in tqdm(enumerate(fin)):
                 yield {
                     '_index': index_name,
-                    '_type': 'document',
+                    '_op_type': op_type,
+                    '_id': doc_id(file, i),
                     'file': file,
                     'line_id': i,
                     'sentence': l.rstrip('\n')
                 }
 
 
-def retrieve(query: str, index_name: str, topk: int):
-    ess = ESSearcher(index_name=index_name)
-    results = ess.get_topk(query_str=query, field='sentence', topk=topk)
-    return [(r['file'], r['line_id'], r['sentence'], s) for r, s in results]
+def bulk_index(es: Elasticsearch, files: List[str], index_name: str, thread_count: int = 4,
+               chunk_size: int = 500, max_chunk_bytes: int = 100 * 1024 * 1024, incremental: bool = False):
+    """Index the lines of the files with parallel bulk requests.
+
+    Refreshes and replicas are turned off while loading and restored afterwards. With incremental,
+    lines that are already indexed are skipped instead of overwritten.
+    """
+    settings = es.indices.get_settings(index=index_name)[index_name]['settings']['index']
+    es.indices.put_settings(index=index_name, body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+    n_indexed, n_skipped, n_errors = 0, 0, 0
+    start = time.time()
+    try:
+        for ok, info in parallel_bulk(es, gendata(files, index_name, op_type='create' if incremental else 'index'),
+                                      thread_count=thread_count, chunk_size=chunk_size,
+                                      max_chunk_bytes=max_chunk_bytes, raise_on_error=False):
+            if ok:
+                n_indexed += 1
+            elif list(info.values())[0].get('status') == 409:
+                n_skipped += 1
+            else:
+                n_errors += 1
+                if n_errors <= 10:
+                    print('error: {}'.format(info))
+            if profiler.enabled:
+                profiler.stage('index', 1)
+    finally:
+        # A missing setting was at its default value, which null restores
+        es.indices.put_settings(index=index_name, body={'index': {
+            'refresh_interval': settings.get('refresh_interval'),
+            'number_of_replicas': settings.get('number_of_replicas')}})
+        es.indices.refresh(index=index_name)
+    elapsed = time.time() - start
+    for field, count in [('indexed', n_indexed), ('skipped', n_skipped), ('errors', n_errors)]:
+        profiler.add('index docs', field, count)
+    print('indexed {} docs, skipped {}, {} errors in {:.1f}s: {:.1f} docs/sec'.format(
+        n_indexed, n_skipped, n_errors, elapsed, (n_indexed + n_skipped) / max(elapsed, 1e-9)))
+
+
+def retrieve_batch(queries: List[str], ess: Searcher, topk: int, batch_size: int = 64, concurrency: int = 4):
+    """Run queries in batches (multi-search requests for ES) with several batches in flight, yielding results in query order."""
+    batches = [queries[i:i + batch_size] for i in range(0, len(queries), batch_size)]
+
+    def run(batch):
+        start = time.perf_counter()
+        batch_results = ess.get_topk_batch(batch, field='sentence', topk=topk)
+        if profiler.enabled:
+            profiler.observe('search_request', time.perf_counter() - start)
+            profiler.stage('retrieve', len(batch))
+        return [[(r['file'], r['line_id'], r['sentence'], s) for r, s in results] for results in batch_results]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for results in executor.map(run, batches):
+            yield from results
+
+
+def load_queries(template_file: str) -> List[str]:
+    with open(template_file, 'r') as f:
+        csvf = csv.reader(f)
+        temp_header = next(csvf)
+        temp_data = list(csvf)
+        return [t[1] for t in temp_data]
+
+
+def get_searcher(backend: str, index_name: str, index_dir: str, concurrency: int) -> Searcher:
+    if backend == 'local':
+        return LocalSearcher(index_dir)
+    return ESSearcher(index_name=index_name, es=Elasticsearch(maxsize=concurrency))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='index cnndm dataset')
-    parser.add_argument('--task', type=str, choices=['index', 'retrieve'], required=True)
+    parser.add_argument('--task', type=str, choices=['index', 'retrieve', 'compare'], required=True)
     parser.add_argument('--inp', type=str, nargs='+', help='input files')
     parser.add_argument('--out', type=str, help='output dir')
     parser.add_argument('--topk', type=int, help='topk for retrieval', default=1)
     parser.add_argument('--delete', action='store_true')
+    parser.add_argument('--backend', type=str, choices=['es', 'local'], default='es',
+                        help='search with Elasticsearch or an in-process index built in --index_dir')
+    parser.add_argument('--index_dir', type=str, help='directory of the local index', default='cord19-index')
+    parser.add_argument('--index_threads', type=int, help='number of parallel bulk indexing threads', default=4)
+    parser.add_argument('--chunk_size', type=int, help='number of docs per bulk request', default=500)
+    parser.add_argument('--max_chunk_bytes', type=int, help='max size of a bulk request in bytes', default=100 * 1024 * 1024)
+    parser.add_argument('--incremental', action='store_true', help='skip lines that are already indexed')
+    parser.add_argument('--batch-size', type=int, help='number of queries per multi-search request', default=64)
+    parser.add_argument('--concurrency', type=int, help='number of multi-search requests in flight', default=4)
+    parser.add_argument('--profile', type=str, help='write a profile (request latencies, throughput) to this .json or .csv file')
+    parser.add_argument('--profile_every', type=float, help='also write the profile every this many seconds', default=0)
     args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile, args.profile_every)
 
     index_name = 'cord19'
 
-    if args.task == 'index':
+    if args.task == 'index' and args.backend == 'local':
+        build_local_index(args.inp, args.index_dir)
+
+    elif args.task == 'index':
         es = Elasticsearch()
         if args.delete:
             print('delete index')
@@ -72,17 +171,39 @@ if __name__ == '__main__':
         print('create index')
         print(es.indices.create(index=index_name, ignore=400))
         print('add docs')
-        print(bulk(es, gendata(args.inp, index_name=index_name)))
+        bulk_index(es, args.inp, index_name, thread_count=args.index_threads, chunk_size=args.chunk_size,
+                   max_chunk_bytes=args.max_chunk_bytes, incremental=args.incremental)
 
     elif args.task == 'retrieve':
-        with open(args.inp[0], 'r') as f:
-            csvf = csv.reader(f)
-            temp_header = next(csvf)
-            temp_data = list(csvf)
-            queries = [t[1] for t in temp_data]
+        queries = load_queries(args.inp[0])
+        # A single client whose connection pool is shared by all concurrent batches
+        ess = get_searcher(args.backend, index_name, args.index_dir, args.concurrency)
+        start = time.time()
         with open(args.out, 'w') as fout:
-            for query in tqdm(queries):
-                result = retrieve(query, index_name=index_name, topk=args.topk)
+            results = retrieve_batch(queries, ess, topk=args.topk, batch_size=args.batch_size,
+                                     concurrency=args.concurrency)
+            for query, result in tqdm(zip(queries, results), total=len(queries)):
                 fout.write('** ' + query + '\n')
                 for r in result:
                     fout.write('{}\t{}\t{}\n'.format(r[0], r[1], r[2]))
+        elapsed = time.time() - start
+        print('{} queries in {:.1f}s: {:.1f} queries/sec'.format(len(queries), elapsed, len(queries) / max(elapsed, 1e-9)))
+
+    elif args.task == 'compare':
+        # Latency of single queries and recall of the ES top-k results in the local top-k results
+        queries = load_queries(args.inp[0])
+        searchers = {backend: get_searcher(backend, index_name, args.index_dir, 1) for backend in ['es', 'local']}
+        latencies, results = {}, {}
+        for backend, searcher in searchers.items():
+            latencies[backend], results[backend] = [], []
+            for query in tqdm(queries, desc=backend):
+                start = time.time()
+                result = searcher.get_topk(query, field='sentence', topk=args.topk)
+                latencies[backend].append(time.time() - start)
+                results[backend].append({(r['file'], r['line_id']) for r, _ in result})
+        for backend, lat in latencies.items():
+            lat = sorted(lat)
+            print('{}: mean {:.1f}ms, p50 {:.1f}ms, p95 {:.1f}ms'.format(
+                backend, 1000 * sum(lat) / len(lat), 1000 * lat[len(lat) // 2], 1000 * lat[int(len(lat) * 0.95)]))
+        recalls = [len(es & local) / len(es) for es, local in zip(results['es'], results['local']) if es]
+        print('recall@{} of local vs es: {:.3f}'.format(args.topk, sum(recalls) / max(len(recalls), 1)))
@@ -1,8 +1,12 @@
-from typing import Iterable, Dict, List, Union
+from typing import Iterable, Iterator, Dict, List, Tuple, Union
 from spacy.lang.en import English
+import argparse
+import itertools
+import multiprocessing
 import sys
 import os
 import json
+import time
 
 nlp = English()
 sentencizer = nlp.create_pipe("sentencizer")
@@ -35,16 +39,62 @@ def get_text(data: Union[Dict, List, str, int]) -> Iterable[str]:
     raise Exception('not support {}'.format(type(data)))
 
 
+batch_size = 64
+
+def segment_file(file: str) -> Tuple[str, List[str], List[List[str]]]:
+  """Read one JSON file and return its file name, its paragraphs and the sentences of each paragraph."""
+  with open(file, 'r') as fin:
+    article = json.load(fin)
+  texts = list(get_text(article))
+  sents = [[str(sent) for sent in doc.sents] for doc in nlp.pipe((text.strip() for text in texts), batch_size=batch_size)]
+  return file, texts, sents
+
+
+def init_worker(worker_batch_size: int):
+  global batch_size
+  batch_size = worker_batch_size
+
+
+def walk_files(root_dir: str) -> Iterable[str]:
+  for root, _, files in os.walk(root_dir):
+    for file in files:
+      yield os.path.join(root, file)
+
+
+def segment_files(files: Iterable[str], pool=None, window: int = 16) -> Iterator[Tuple[str, List[str], List[List[str]]]]:
+  """Segment files with `segment_file`, in the pool if there is one, and yield the results in file order."""
+  files = iter(files)
+  while True:
+    # Only a bounded window of files is in flight at once
+    batch = list(itertools.islice(files, window))
+    if not batch:
+      return
+    yield from (pool.imap(segment_file, batch) if pool else map(segment_file, batch))
+
+
 if __name__ == '__main__':
-  root_dir, txt_out, sent_out =sys.argv[1:]
-  with open(txt_out, 'w') as text_fout, open(sent_out, 'w') as sent_fout:
-    for root, _, files in os.walk(root_dir):
-      for file in files:
-        file = os.path.join(root, file)
-        with open(file, 'r') as fin:
-          article = json.load(fin)
-          for text in get_text(article):
-            text_fout.write('{}\t{}\n'.format(file, text))
-            doc = nlp(text.strip())
-            for sent in doc.sents:
-              sent_fout.write('{}\t{}\n'.format(file, sent))
+  parser = argparse.ArgumentParser(description='Split the paragraphs of CORD-19 JSON files into sentences')
+  parser.add_argument('root_dir', type=str, help='Directory of JSON files (e.g. pdf_json)')
+  parser.add_argument('txt_out', type=str, help='Output file with one paragraph per line')
+  parser.add_argument('sent_out', type=str, help='Output file with one sentence per line')
+  parser.add_argument('--workers', type=int, default=1, help='Number of processes to segment files with')
+  parser.add_argument('--batch-size', type=int, default=64, help='Number of paragraphs per nlp.pipe batch')
+  args = parser.parse_args()
+
+  init_worker(args.batch_size)
+  start, n_docs, n_sents = time.time(), 0, 0
+  pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args.batch_size,)) if args.workers > 1 else None
+  with open(args.txt_out, 'w') as text_fout, open(args.sent_out, 'w') as sent_fout:
+    for file, texts, sents in segment_files(walk_files(args.root_dir), pool, max(args.workers, 1) * 16):
+      for text, para_sents in zip(texts, sents):
+        text_fout.write('{}\t{}\n'.format(file, text))
+        for sent in para_sents:
+          sent_fout.write('{}\t{}\n'.format(file, sent))
+        n_sents += len(para_sents)
+      n_docs += 1
+  if pool:
+    pool.close()
+    pool.join()
+  elapsed = time.time() - start
+  print('segmented {} docs ({} sentences) in {:.1f}s: {:.1f} docs/sec'.format(
+    n_docs, n_sents, elapsed, n_docs / max(elapsed, 1e-9)), file=sys.stderr)